@@ -0,0 +1,519 @@
+# Offline benchmark for the bot's audio paths.
+#
+# Drives the real command handlers from main.py (say, play, skip, queue and,
+# through them, play_next) against local stand-ins: a fake Interaction and
+# VoiceClient that consumes frames at real-time pace, a fake extractor that
+# serves generated WAV files, and a fake TTS engine. No Discord, YouTube or
+# Google access is needed; ffmpeg must be on PATH. Music takes the Opus path
+# when ffmpeg is found, which needs libopus for mixing; set
+# DISABLE_OPUS_TRANSCODE=1 to benchmark the PCM path instead.
+#
+# The fake voice client enforces discord.py's encoder rule (PCM only works if
+# the connection's first source wasn't Opus), and the run fails if it's broken.
+# Also streams an MP3 fixture (made with ffmpeg's libmp3lame) through the /say
+# decoder and exits non-zero if the first frame waits for the whole file or if
+# memory grows with the clip past what the TTS cache would keep of it.
+#
+#   python benchmark.py --guilds 4 --tracks 3 --output bench.json
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Must be set before main.py is imported
+BENCH_DIR = tempfile.mkdtemp(prefix="voicebot-bench-")
+BENCH_USER_ID = 1
+os.environ["ADMIN_ID"] = str(BENCH_USER_ID)
+os.environ["EXTRACT_CACHE_FILE"] = os.path.join(BENCH_DIR, "extract_cache.db")
+os.environ["STATE_FILE"] = os.path.join(BENCH_DIR, "bot_state.db")
+os.environ["LOUDNESS_FILE"] = os.path.join(BENCH_DIR, "loudness.db")
+os.environ.setdefault("TTS_ENGINE", "bench")
+# 2 MB largest cached clip, so the default MP3 fixture is too long to cache
+os.environ.setdefault("TTS_CACHE_MAX_BYTES", str(8 * 1024 * 1024))
+
+import numpy as np
+import main
+
+FRAME_DELAY = 0.02
+
+# --- Stand-ins for Discord ---
+class FakeVoiceClient:
+    # Plays sources the way discord.py's AudioPlayer does: one read() every 20 ms
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.thread = None
+        self.end = threading.Event()
+        self.connected = True
+        self.frames = 0
+        self.late_frames = 0
+        self.silence_frames = 0
+        # (time play() was called, time of first frame) per source
+        self.first_frames = []
+        self.gaps = []
+        self.last_end = None
+        self.playing = False
+        # Like discord.py: only created if a source wasn't Opus when play() was called
+        self.encoder = None
+        self.encoder_errors = 0
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, *, after=None):
+        if self.playing:
+            raise RuntimeError("Already playing audio.")
+        self.source = source
+        self.playing = True
+        if self.encoder is None and not source.is_opus():
+            self.encoder = object()
+        self.end = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(source, after, self.end), daemon=True)
+        self.thread.start()
+
+    def _run(self, source, after, end):
+        called = time.monotonic()
+        start = None
+        loops = 0
+        error = None
+        while not end.is_set():
+            data = source.read()
+            if not data:
+                break
+            if not source.is_opus() and self.encoder is None:
+                # discord.py's player thread dies here on MISSING.encode()
+                self.encoder_errors += 1
+                error = RuntimeError("PCM frame but the voice client has no encoder")
+                break
+            now = time.monotonic()
+            if start is None:
+                start = now
+                self.first_frames.append((called, now))
+                if self.last_end is not None:
+                    self.gaps.append(now - self.last_end)
+                    self.last_end = None
+            elif now > start + FRAME_DELAY * (loops + 1):
+                self.late_frames += 1
+            if data is main.SILENCE_FRAME:
+                self.silence_frames += 1
+            self.frames += 1
+            loops += 1
+            time.sleep(max(0, start + FRAME_DELAY * loops - time.monotonic()))
+
+        self.last_end = time.monotonic()
+        self.playing = False
+        source.cleanup()
+        if after:
+            after(error)
+
+    def stop(self):
+        # Like discord.py, does not wait for the player thread; after() runs there
+        self.end.set()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"bench-{guild_id}"
+        self.voice_client = None
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def edit_message(self, **kwargs):
+        pass
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeUser:
+    def __init__(self, channel):
+        self.id = BENCH_USER_ID
+        self.mention = f"<@{BENCH_USER_ID}>"
+        self.voice = FakeVoiceState(channel)
+
+class FakeInteraction:
+    def __init__(self, guild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = FakeUser(FakeChannel(guild))
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+# --- Stand-ins for yt-dlp and TTS ---
+def write_wav(path, seconds, freq):
+    t = np.arange(int(48000 * seconds)) / 48000
+    tone = (np.sin(2 * np.pi * freq * t) * 8000).astype(np.int16)
+    pcm = np.repeat(tone, 2).tobytes()
+    with open(path, 'wb') as f:
+        f.write(b'RIFF' + struct.pack('<I', 36 + len(pcm)) + b'WAVE')
+        f.write(b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 2, 48000, 48000 * 4, 4, 16))
+        f.write(b'data' + struct.pack('<I', len(pcm)) + pcm)
+
+class FakeExtractor:
+    # Replaces ExtractionService.extract; bench://playlist/N lists N local tracks.
+    # Tracks are served over local HTTP so ffmpeg runs with the real network options.
+    def __init__(self, track_urls, latency):
+        self.track_urls = track_urls
+        self.latency = latency
+
+    async def extract(self, guild_id, url, flat=False, items=None, priority=main.PRIORITY_INTERACTIVE, timeout=None,
+                      cancellable=True):
+        # Still goes through the real admission budget
+        async with main.extraction.budget.slot(guild_id, priority):
+            started = time.monotonic()
+            await asyncio.sleep(self.latency)
+        kind, _, arg = url[len("bench://"):].partition("/")
+        if kind == "playlist":
+            entries = [
+                {'title': f"Track {i}", 'url': f"bench://track/{i}"}
+                for i in range(int(arg))
+            ]
+            # Honour the head/rest split play() asks for
+            if items:
+                start, _, end = items.replace(':', '-').partition('-')
+                entries = entries[int(start) - 1:int(end) if end else None]
+            result = {'entries': entries, 'count': len(entries), 'total': int(arg)}
+        else:
+            index = int(arg) % len(self.track_urls)
+            result = {
+                'url': self.track_urls[index],
+                'title': f"Track {arg}",
+                'duration': None,
+                'webpage_url': url,
+                'acodec': 'pcm_s16le',
+            }
+        main.EXTRACT_SECONDS.observe("flat" if flat else "full", value=time.monotonic() - started)
+        return result
+
+class BenchTTSEngine(main.TTSEngine):
+    # Produces a tone after a fixed "network" delay, as raw 48 kHz stereo PCM
+    name = "bench"
+    label = "Benchmark"
+    remote = False
+    ffmpeg_input_args = ['-f', 's16le', '-ar', '48000', '-ac', '2', '-i', 'pipe:0']
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def synthesize(self, text, voice, write):
+        time.sleep(self.latency)
+        samples = int(48000 * 0.06 * len(text))
+        tone = (np.sin(np.arange(samples) * 0.05) * 6000).astype(np.int16)
+        write(np.repeat(tone, 2).tobytes())
+
+# --- Scenario ---
+SAY_TEXT = (
+    "Добрый вечер! Это проверка озвучки длинного сообщения. "
+    "Она разбивается на несколько частей, которые синтезируются параллельно."
+)
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+async def run_guild(guild_id, args):
+    guild = FakeGuild(guild_id)
+    ix = FakeInteraction(guild)
+    result = {'guild': guild_id}
+
+    # Speech on an idle channel. Odd guilds skip it, so their connection starts
+    # with music: with Opus music the voice client then has no PCM encoder.
+    speech_first = guild_id % 2 == 0
+    if speech_first:
+        started = time.monotonic()
+        await main.say.callback(ix, SAY_TEXT)
+        vc = guild.voice_client
+        await wait_for(lambda: vc.first_frames, 10)
+        if vc.first_frames:
+            result['tts_first_audio'] = vc.first_frames[0][1] - started
+        await wait_for(lambda: not vc.is_playing(), 60)
+        vc.last_end = None
+
+    # A playlist, an announcement over it, a skip, and the rest played out
+    started = time.monotonic()
+    await main.play.callback(ix, f"bench://playlist/{args.tracks}")
+    vc = guild.voice_client
+    music_index = 1 if speech_first else 0
+    await wait_for(lambda: len(vc.first_frames) > music_index, 30)
+    if len(vc.first_frames) > music_index:
+        result['music_first_audio'] = vc.first_frames[music_index][1] - started
+
+    await asyncio.sleep(args.track_seconds / 3)
+    await main.say.callback(ix, "Короткое объявление.")
+    await main.queue.callback(ix)
+    await asyncio.sleep(args.track_seconds / 3)
+    await main.skip.callback(ix)
+
+    await wait_for(lambda: not vc.is_playing() and not main.get_queue(guild_id), args.tracks * args.track_seconds + 30)
+    await asyncio.sleep(0.2)
+
+    result['gaps'] = vc.gaps
+    result['frames'] = vc.frames
+    result['late_frames'] = vc.late_frames
+    result['silence_frames'] = vc.silence_frames
+    result['encoder_errors'] = vc.encoder_errors
+    await vc.disconnect()
+    return result
+
+def summarize(values):
+    values = sorted(v * 1000 for v in values)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 1),
+        'p50': round(values[len(values) // 2], 1),
+        'p95': round(values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)], 1),
+        'max': round(values[-1], 1),
+    }
+
+def bench_mixer(frames=5000):
+    # Per-frame cost of mixing speech over music with ducking
+    class Tone(main.discord.AudioSource):
+        frame = np.full(main.FRAME_SIZE // 2, 1000, np.int16).tobytes()
+
+        def read(self):
+            return self.frame
+
+    mixer = main.MixingAudioSource(Tone())
+    mixer.add_overlay(Tone())
+    started = time.perf_counter()
+    for _ in range(frames):
+        mixer.read()
+    return (time.perf_counter() - started) / frames * 1e6
+
+def write_mp3(path, seconds):
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f"sine=frequency=330:duration={seconds}",
+         '-ac', '1', '-c:a', 'libmp3lame', '-b:a', '64k', path],
+        check=True
+    )
+
+def bench_mp3_decode(seconds, piece_bytes=4096, piece_delay=0.02):
+    # Streams an MP3 into the /say decoder the way an engine delivers it: in
+    # pieces, over time, with the same cache hook and limit say() uses. Frames
+    # are drained as fast as they come, so the Python-side peak is the buffers
+    # plus at most one cacheable clip, not the whole decoded clip.
+    path = os.path.join(BENCH_DIR, "speech.mp3")
+    write_mp3(path, seconds)
+    with open(path, 'rb') as f:
+        mp3 = f.read()
+
+    chunk = main.SpeechChunk("bench")
+
+    def deliver():
+        for offset in range(0, len(mp3), piece_bytes):
+            chunk.write(mp3[offset:offset + piece_bytes])
+            time.sleep(piece_delay)
+        chunk.finish()
+
+    cached = []
+    max_frames = main.tts_cache.max_entry_bytes // main.FRAME_SIZE
+
+    tracemalloc.start()
+    source = main.ChunkedTTSAudioSource([chunk], on_complete=cached.append, max_frames=max_frames)
+    started = time.monotonic()
+    threading.Thread(target=deliver, daemon=True).start()
+    first_frame = None
+    frames = 0
+    try:
+        while True:
+            data = source.read()
+            if not data:
+                break
+            if data is main.SILENCE_FRAME:
+                continue
+            if first_frame is None:
+                first_frame = time.monotonic() - started
+            frames += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        source.cleanup()
+
+    return {
+        'clip_seconds': seconds,
+        'mp3_bytes': len(mp3),
+        'delivery_ms': round(len(range(0, len(mp3), piece_bytes)) * piece_delay * 1000, 1),
+        'first_frame_ms': round(first_frame * 1000, 1) if first_frame is not None else None,
+        'frames': frames,
+        'decoded_bytes': frames * main.FRAME_SIZE,
+        'cache_limit_bytes': max_frames * main.FRAME_SIZE,
+        'cached': bool(cached),
+        'peak_traced_kb': round(peak / 1024, 1),
+    }
+
+def check_mp3_decode(result):
+    failures = []
+    if not result['frames'] or result['first_frame_ms'] is None:
+        failures.append("MP3 decode produced no audio")
+        return failures
+    # Streaming means the first frame is out well before the MP3 has all arrived
+    if result['first_frame_ms'] > result['delivery_ms'] / 2:
+        failures.append(
+            f"first frame after {result['first_frame_ms']} ms, "
+            f"the MP3 took {result['delivery_ms']} ms to arrive"
+        )
+    # Bounded buffering: the frames kept for the cache, if the clip fits, plus
+    # the pipe and frame buffers, however long the clip is
+    kept = min(result['decoded_bytes'], result['cache_limit_bytes'])
+    if result['peak_traced_kb'] * 1024 > kept + 512 * 1024:
+        failures.append(
+            f"peak Python memory {result['peak_traced_kb']} KiB for "
+            f"{result['decoded_bytes'] / 1024:.0f} KiB of decoded audio "
+            f"(cache limit {result['cache_limit_bytes'] / 1024:.0f} KiB)"
+        )
+    if result['cached'] != (result['decoded_bytes'] <= result['cache_limit_bytes']):
+        failures.append(f"clip of {result['decoded_bytes']} bytes cached: {result['cached']}")
+    return failures
+
+async def serve_tracks(args):
+    names = []
+    for i in range(args.tracks):
+        name = f"track{i}.wav"
+        write_wav(os.path.join(BENCH_DIR, name), args.track_seconds, 220 + 55 * i)
+        names.append(name)
+
+    app = main.web.Application()
+    app.router.add_static('/', BENCH_DIR)
+    runner = main.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = main.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, [f"http://127.0.0.1:{port}/{name}" for name in names]
+
+async def run(args):
+    runner, track_urls = await serve_tracks(args)
+    try:
+        report = await run_scenario(args, track_urls)
+    finally:
+        await runner.cleanup()
+    # Alone, after the guild scenario, so tracemalloc sees only this clip
+    report['mp3_decode'] = bench_mp3_decode(args.mp3_seconds)
+    return report
+
+async def run_scenario(args, track_urls):
+    main.extraction.extract = FakeExtractor(track_urls, args.extract_latency).extract
+    main.TTS_ENGINES['bench'] = BenchTTSEngine(args.tts_latency)
+    main.bot.loop = asyncio.get_running_loop()
+    main.decoder_pool.warm_up()
+
+    cpu_before = time.process_time()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_before = time.monotonic()
+
+    results = await asyncio.gather(*(run_guild(1000 + i, args) for i in range(args.guilds)))
+
+    wall = time.monotonic() - wall_before
+    cpu = time.process_time() - cpu_before
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    children_cpu = (children.ru_utime - children_before.ru_utime) + (children.ru_stime - children_before.ru_stime)
+    stream_seconds = sum(r['frames'] for r in results) * FRAME_DELAY
+
+    return {
+        'config': vars(args),
+        'tts_first_audio_ms': summarize([r['tts_first_audio'] for r in results if 'tts_first_audio' in r]),
+        'music_first_audio_ms': summarize([r['music_first_audio'] for r in results if 'music_first_audio' in r]),
+        'inter_track_gap_ms': summarize([gap for r in results for gap in r['gaps']]),
+        'frames': sum(r['frames'] for r in results),
+        'late_frames': sum(r['late_frames'] for r in results),
+        'silence_frames': sum(r['silence_frames'] for r in results),
+        'encoder_errors': sum(r['encoder_errors'] for r in results),
+        'cpu': {
+            'wall_seconds': round(wall, 2),
+            'bot_cpu_seconds': round(cpu, 3),
+            'ffmpeg_cpu_seconds': round(children_cpu, 3),
+            # CPU seconds spent per second of audio delivered, in percent of one core
+            'bot_pct_per_stream': round(cpu / stream_seconds * 100, 2) if stream_seconds else None,
+            'ffmpeg_pct_per_stream': round(children_cpu / stream_seconds * 100, 2) if stream_seconds else None,
+        },
+        'memory': {
+            # ru_maxrss is KiB on Linux
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        'mixer_frame_us': round(bench_mixer(), 1),
+        'playback_paths': {str(k): v for k, v in main.playback_path_stats.items()},
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the voice bot")
+    parser.add_argument("--guilds", type=int, default=4, help="simulated guilds running at once")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks per playlist")
+    parser.add_argument("--track-seconds", type=float, default=4.0, help="length of each generated track")
+    parser.add_argument("--extract-latency", type=float, default=0.3, help="simulated yt-dlp latency, seconds")
+    parser.add_argument("--tts-latency", type=float, default=0.2, help="simulated TTS latency per chunk, seconds")
+    parser.add_argument("--mp3-seconds", type=float, default=30.0, help="length of the MP3 decode fixture")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    main.decoder_pool.shutdown()
+    main.tts_executor.shutdown(wait=False, cancel_futures=True)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    failures = check_mp3_decode(report['mp3_decode'])
+    if report['encoder_errors']:
+        failures.append(f"{report['encoder_errors']} PCM frames sent to a voice client without an encoder")
+    for failure in failures:
+        print(f"❌ {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,77 @@
+# yt-dlp extraction, run in the bot's extraction worker processes.
+#
+# The workers are started with "spawn", not fork, so they don't inherit the
+# bot's open pipes: a forked worker holding the write end of a TTS decoder's
+# stdin keeps that decoder from ever seeing EOF. Spawned workers import the
+# functions they run by module name, so they live here rather than in main.py.
+
+# YT-DLP Options
+YTDL_OPTIONS = {
+    'format': 'bestaudio/best',
+    'noplaylist': True, # We handle playlists manually
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',
+}
+
+# Flat extraction for play(): lists playlist entries without resolving each one
+YTDL_FLAT_OPTIONS = {
+    'extract_flat': 'in_playlist',
+    'quiet': True,
+    'default_search': 'auto',
+    'ignoreerrors': True,
+}
+
+# Per-process YoutubeDL instances, created once by the pool initializer and reused
+_ytdl = None
+_ytdl_flat = None
+
+def init_worker():
+    global _ytdl, _ytdl_flat
+    # Only the pool processes ever import yt-dlp
+    import yt_dlp
+    _ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    _ytdl_flat = yt_dlp.YoutubeDL(YTDL_FLAT_OPTIONS)
+
+def slim_listing(data, url):
+    # Keep only the fields play() and the /play suggestions need, so cached listings stay small
+    if 'entries' in data:
+        entries = []
+        # Raw entry count, including unavailable ones, so callers can tell if a range was full
+        count = 0
+        for entry in data['entries']:
+            count += 1
+            if entry:
+                entries.append({
+                    'title': entry.get('title', 'Unknown Track'),
+                    'url': entry.get('url') or entry.get('webpage_url'),
+                    'duration': entry.get('duration'),
+                })
+        return {'entries': entries, 'count': count, 'total': data.get('playlist_count')}
+    return {
+        'title': data.get('title', 'Unknown'),
+        'webpage_url': data.get('webpage_url', url),
+    }
+
+def extract(url, flat, items=None):
+    # Runs in the pool process; returns only small, picklable dicts
+    if flat:
+        # Workers are single-threaded, so switching the range per call is safe
+        _ytdl_flat.params['playlist_items'] = items
+        data = _ytdl_flat.extract_info(url, download=False)
+        return slim_listing(data, url)
+
+    data = _ytdl.extract_info(url, download=False)
+    if 'entries' in data:
+        data = data['entries'][0]
+    return {
+        'url': data['url'],
+        'title': data.get('title'),
+        'duration': data.get('duration'),
+        'webpage_url': data.get('webpage_url', url),
+        'acodec': data.get('acodec'),
+    }
@@ -1,26 +1,80 @@
+import time
+# Startup timing starts here, before the imports
+STARTUP_STARTED = time.perf_counter()
+
 import discord
 from discord.ext import commands
 from discord import app_commands
-from gtts import gTTS
 import io
 import os
 import asyncio
 import json
+import math
+import re
+from queue import Queue, Empty, Full
+import concurrent.futures
+import importlib.util
+import sqlite3
+import urllib.parse
+import hashlib
+import array
+import mmap
+import shlex
+import struct
+import subprocess
+import threading
+import shutil
+import signal
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import traceback
 from dotenv import load_dotenv
-import static_ffmpeg
-import yt_dlp
+import aiohttp
+from aiohttp import web
+import numpy as np
 import sys
+import itertools
+import random
+import multiprocessing
+from collections import OrderedDict, deque
 
-# Ensure ffmpeg is available
-static_ffmpeg.add_paths()
+import extract_worker
 
-load_dotenv()
+# yt_dlp, gtts, edge_tts and static_ffmpeg are imported where they're first
+# used: they are slow to import and most of them are only needed much later.
 
-# Configure intents
-intents = discord.Intents.default()
-intents.message_content = True
+startup_marks = [("start", STARTUP_STARTED)]
+
+def mark_startup(phase):
+    startup_marks.append((phase, time.perf_counter()))
+
+def startup_report():
+    steps = ", ".join(
+        f"{name} {(at - prev) * 1000:.0f} ms"
+        for (_, prev), (name, at) in zip(startup_marks, startup_marks[1:])
+    )
+    return f"⏱️ Startup {(startup_marks[-1][1] - STARTUP_STARTED) * 1000:.0f} ms: {steps}"
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+mark_startup("imports")
+
+_ffmpeg_lock = threading.Lock()
+
+def ensure_ffmpeg():
+    # static_ffmpeg may download binaries, so it's only tried when ffmpeg isn't
+    # installed (the Docker image has it), and never on the event loop
+    with _ffmpeg_lock:
+        if shutil.which("ffmpeg"):
+            return True
+        try:
+            import static_ffmpeg
+            static_ffmpeg.add_paths()
+        except Exception as e:
+            print(f"⚠️ static_ffmpeg failed: {e}")
+        return shutil.which("ffmpeg") is not None
+
+load_dotenv()
 
 # --- Load Opus Library (Required for Voice) ---
 if not discord.opus.is_loaded():
@@ -49,30 +103,733 @@ if not discord.opus.is_loaded():
 
 
 # Constants
+# Only read once, to import the allow-list into the state database
 ALLOWED_USERS_FILE = "allowed_users.json"
+STATE_FILE = os.getenv("STATE_FILE", "bot_state.db")
+STATE_FLUSH_INTERVAL = 1.0
+
+# Cluster mode: CLUSTER_WORKERS > 1 runs shards in that many processes.
+# CLUSTER_ID is only set in the worker processes the supervisor starts.
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", 0))
+CLUSTER_ID = os.getenv("CLUSTER_ID")
 ADMIN_ID = os.getenv("ADMIN_ID")
 
+# TTS cache: memory budget in bytes, optional directory for the disk tier and its budget
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR")
+TTS_CACHE_DISK_MAX_BYTES = int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+
+# TTS engines: default engine, gTTS language, espeak voice, and when to fall back
+DEFAULT_TTS_ENGINE = os.getenv("TTS_ENGINE", "edge")
+GTTS_LANG = os.getenv("GTTS_LANG", "ru")
+LOCAL_TTS_VOICE = os.getenv("LOCAL_TTS_VOICE", "ru")
+TTS_LATENCY_BUDGET = float(os.getenv("TTS_LATENCY_BUDGET", 2.5))
+TTS_ENGINE_COOLDOWN = 60
+
+# yt-dlp result cache: SQLite file, metadata lifetime in seconds, max rows per table
+EXTRACT_CACHE_FILE = os.getenv("EXTRACT_CACHE_FILE", "extract_cache.db")
+EXTRACT_CACHE_METADATA_TTL = int(os.getenv("EXTRACT_CACHE_METADATA_TTL", 7 * 24 * 3600))
+EXTRACT_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACT_CACHE_MAX_ENTRIES", 5000))
+
+# Loudness normalization: SQLite index of measured tracks, default target in LUFS
+LOUDNESS_FILE = os.getenv("LOUDNESS_FILE", "loudness.db")
+LOUDNESS_TARGET = float(os.getenv("LOUDNESS_TARGET", -14))
+
+# --- Metrics ---
+# Minimal Prometheus text-format metrics. Observations come from the event
+# loop and from audio player threads, so every metric takes a lock.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape_label_value(value):
+    # The text format needs backslash, double quote and newline escaped
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape_label_value(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        super().__init__(name, help_text, labels)
+        # Optional callback returning {label_values: value}, evaluated at scrape time
+        self.collect = collect
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        if self.collect:
+            return [(self.name, self.labels, key, value) for key, value in self.collect().items()]
+        return super().samples()
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label_values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        with self.lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for key, data in self.values.items():
+                for bound, count in zip(self.buckets, data):
+                    result.append((f"{self.name}_bucket", self.labels + ('le',), key + (bound,), count))
+                result.append((f"{self.name}_bucket", self.labels + ('le',), key + ('+Inf',), data[-1]))
+                result.append((f"{self.name}_sum", self.labels, key, data[-2]))
+                result.append((f"{self.name}_count", self.labels, key, data[-1]))
+        return result
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, label_names, label_values, value in metric.samples():
+                lines.append(f"{name}{_format_labels(label_names, label_values)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+TTS_GENERATION_SECONDS = metrics.register(Histogram(
+    "voicebot_tts_generation_seconds", "Time until the first synthesized audio is available", ("engine",)))
+FFMPEG_DECODE_SECONDS = metrics.register(Histogram(
+    "voicebot_ffmpeg_decode_seconds", "Time from feeding a decoder to its first PCM frame"))
+EXTRACT_SECONDS = metrics.register(Histogram(
+    "voicebot_extract_seconds", "yt-dlp extract_info latency", ("kind",)))
+FIRST_FRAME_SECONDS = metrics.register(Histogram(
+    "voicebot_time_to_first_frame_seconds", "Time from request to the first audio frame", ("kind",)))
+TRACK_GAP_SECONDS = metrics.register(Histogram(
+    "voicebot_track_gap_seconds", "Silence between the end of a track and the start of the next"))
+ERRORS_TOTAL = metrics.register(Counter(
+    "voicebot_errors_total", "Errors by kind", ("kind",)))
+SKIPS_TOTAL = metrics.register(Counter(
+    "voicebot_skips_total", "Tracks skipped with /skip"))
+
+# --- Diagnostics: Loop Lag, Slow Callbacks, Tracing and Profiling ---
+LOOP_LAG_INTERVAL = 0.1
+# A loop stalled longer than this is reported with the stack of the code holding it
+LOOP_SLOW_CALLBACK = float(os.getenv("LOOP_SLOW_CALLBACK", 0.1))
+SLOW_COMMAND_SECONDS = float(os.getenv("SLOW_COMMAND_SECONDS", 3))
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP = 40
+
+LOOP_LAG_SECONDS = metrics.register(Histogram(
+    "voicebot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)))
+SLOW_CALLBACKS_TOTAL = metrics.register(Counter(
+    "voicebot_slow_callbacks_total", "Times the event loop was blocked longer than LOOP_SLOW_CALLBACK"))
+COMMAND_SECONDS = metrics.register(Histogram(
+    "voicebot_command_seconds", "Slash command handler duration", ("command", "status")))
+SPAN_SECONDS = metrics.register(Histogram(
+    "voicebot_span_seconds", "Duration of traced steps inside commands and playback", ("span",)))
+
+class LoopMonitor:
+    # A task sleeps LOOP_LAG_INTERVAL and measures how late it wakes up. A
+    # watchdog thread checks the task's heartbeat; when the loop has been stuck
+    # for longer than LOOP_SLOW_CALLBACK it logs what the loop thread is running
+    # right now, so the blocking call shows up in the stack while it still blocks.
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_SLOW_CALLBACK):
+        self.interval = interval
+        self.threshold = threshold
+        self.loop = None
+        self.thread_id = None
+        self.heartbeat = time.monotonic()
+        self.task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+        self.max_lag = 0.0
+        self.recent_lags = deque(maxlen=600)
+        self.slow_callbacks = deque(maxlen=20)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = self.loop.create_task(self._sample())
+        self.watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self.heartbeat = now
+            self.recent_lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(value=lag)
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or reported == heartbeat:
+                continue
+            # One report per stall; the lag sample records how long it lasted
+            reported = heartbeat
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self.loop)
+            coro = task.get_coro() if task else None
+            where = getattr(coro, '__qualname__', None) or (task.get_name() if task else "callback")
+            stack = "".join(traceback.format_stack(frame)[-8:])
+            SLOW_CALLBACKS_TOTAL.inc()
+            self.slow_callbacks.append({'at': time.time(), 'stalled': stalled, 'where': where, 'stack': stack})
+            print(f"⚠️ Event loop blocked for {stalled * 1000:.0f}+ ms in {where}:\n{stack}")
+
+    def stats(self):
+        lags = sorted(self.recent_lags)
+        return {
+            'samples': len(lags),
+            'p50': lags[len(lags) // 2] if lags else 0.0,
+            'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0,
+            'max': self.max_lag,
+            'slow_callbacks': list(self.slow_callbacks),
+        }
+
+loop_monitor = LoopMonitor()
+
+# Per-command traces. The command tree opens a Trace for every slash command
+# and trace_span() records named steps into whichever trace is current, so a
+# slow /play shows where the time went (extraction, voice connect, ...).
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    def __init__(self, name, guild_id):
+        self.name = name
+        self.guild_id = guild_id
+        self.started = time.monotonic()
+        self.spans = []  # (name, offset, duration)
+        self.finished = False
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.monotonic() - self.started
+        COMMAND_SECONDS.observe(self.name, status, value=duration)
+        if duration >= SLOW_COMMAND_SECONDS:
+            steps = ", ".join(f"{name} +{offset * 1000:.0f}ms/{span * 1000:.0f}ms" for name, offset, span in self.spans)
+            print(f"🐢 /{self.name} took {duration * 1000:.0f} ms ({status}) [{steps}]")
+
+@contextlib.contextmanager
+def trace_span(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started
+        SPAN_SECONDS.observe(name, value=duration)
+        trace = current_trace.get()
+        # Background tasks inherit the trace of the command that started them
+        if trace and not trace.finished:
+            trace.spans.append((name, started - trace.started, duration))
+
+class TracingCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        if interaction.type is discord.InteractionType.application_command and interaction.command:
+            trace = Trace(interaction.command.qualified_name, interaction.guild_id)
+            interaction.extras['trace'] = trace
+            # Set inside the task that runs the command, so its awaits see it
+            current_trace.set(trace)
+        return True
+
+    async def on_error(self, interaction, error):
+        trace = interaction.extras.get('trace')
+        if trace:
+            trace.finish("error")
+        await super().on_error(interaction, error)
+
+# On-demand profiling for admins. cProfile sees only the event loop thread
+# (where blocking hurts most); the sampler walks every thread, including
+# audio players and TTS readers, and reports where they spend their time.
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.self_counts = {}
+        self.total_counts = {}
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                self.samples += 1
+                self.self_counts[stack[0]] = self.self_counts.get(stack[0], 0) + 1
+                for func in set(stack):
+                    self.total_counts[func] = self.total_counts.get(func, 0) + 1
+                key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def report(self):
+        lines = [f"Samples: {self.samples} (every {self.interval * 1000:.0f} ms, all threads)", ""]
+        for title, counts in (("Self", self.self_counts), ("Inclusive", self.total_counts)):
+            lines.append(f"Top {title.lower()} samples:")
+            for func, count in sorted(counts.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+                lines.append(f"{count:8d} {count / max(self.samples, 1) * 100:6.1f}%  {func}")
+            lines.append("")
+        # Collapsed stacks, ready for flamegraph.pl or speedscope
+        lines.append("Collapsed stacks:")
+        for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            lines.append(f"{stack} {count}")
+        return "\n".join(lines)
+
+class CProfileSession:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        # Called on the loop thread, so that is the thread being profiled
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def report(self):
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        for key in ("tottime", "cumulative"):
+            out.write(f"--- Sorted by {key} ---\n")
+            stats.sort_stats(key).print_stats(PROFILE_TOP)
+        return out.getvalue()
+
+# The running profile, if any: (mode, session, done event)
+active_profile = None
+
+# Configure intents
+intents = discord.Intents.default()
+intents.message_content = True
+
+if CLUSTER_ID is not None:
+    # A cluster worker runs only the shards the supervisor assigned to it
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents, tree_cls=TracingCommandTree,
+        shard_ids=[int(shard) for shard in os.environ["SHARD_IDS"].split(",")],
+        shard_count=int(os.environ["SHARD_COUNT"])
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=TracingCommandTree)
+
 # Store voice settings: guild_id -> voice_name
 guild_settings = {}
 
-# Store music queues: guild_id -> list of {'web_url': str, 'title': str}
+# Store TTS engine per guild: guild_id -> engine name
+guild_engines = {}
+
+# Music loudness target per guild: guild_id -> LUFS (LOUDNESS_OFF disables it)
+guild_loudness = {}
+
+# --- Guild Queues ---
+class Track:
+    __slots__ = ('web_url', 'title')
+
+    def __init__(self, web_url, title):
+        self.web_url = web_url
+        self.title = title
+
+class GuildQueue:
+    # Upcoming tracks in a deque (O(1) at both ends), plus the current track
+    # and a bounded history for /previous
+    def __init__(self, history_size=50, on_change=None):
+        self.tracks = deque()
+        self.current = None
+        self.history = deque(maxlen=history_size)
+        # Called after every change, so the state store can persist the queue
+        self.on_change = on_change
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def append(self, track):
+        self.tracks.append(track)
+        self._changed()
+
+    def appendleft(self, track):
+        self.tracks.appendleft(track)
+        self._changed()
+
+    def extend(self, tracks):
+        self.tracks.extend(tracks)
+        self._changed()
+
+    def next(self):
+        # Advance: the finished track goes to history, the next one becomes current
+        if self.current is not None:
+            self.history.append(self.current)
+        self.current = self.tracks.popleft() if self.tracks else None
+        self._changed()
+        return self.current
+
+    def previous(self):
+        # Put the last played track (and the current one after it) back at the front
+        if not self.history:
+            return None
+        track = self.history.pop()
+        if self.current is not None:
+            self.tracks.appendleft(self.current)
+            self.current = None
+        self.tracks.appendleft(track)
+        self._changed()
+        return track
+
+    def discard(self, web_url):
+        # Drop every upcoming entry of this URL; returns how many were removed
+        before = len(self.tracks)
+        self.tracks = deque(track for track in self.tracks if track.web_url != web_url)
+        removed = before - len(self.tracks)
+        if removed:
+            self._changed()
+        return removed
+
+    def peek(self, count):
+        return list(itertools.islice(self.tracks, count))
+
+    def page(self, page, per_page):
+        start = page * per_page
+        return list(itertools.islice(self.tracks, start, start + per_page))
+
+    def remove(self, index):
+        track = self.tracks[index]
+        del self.tracks[index]
+        self._changed()
+        return track
+
+    def move(self, src, dst):
+        track = self.remove(src)
+        self.tracks.insert(dst, track)
+        self._changed()
+        return track
+
+    def shuffle(self):
+        tracks = list(self.tracks)
+        random.shuffle(tracks)
+        self.tracks = deque(tracks)
+        self._changed()
+
+    def clear(self):
+        self.tracks.clear()
+        self.current = None
+        self._changed()
+
+# Store music queues: guild_id -> GuildQueue
 music_queues = {}
 
-# --- Persistence for Allowed Users ---
-def load_allowed_users():
-    if not os.path.exists(ALLOWED_USERS_FILE):
-        return []
-    try:
-        with open(ALLOWED_USERS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return []
+def get_queue(guild_id):
+    queue = music_queues.get(guild_id)
+    if queue is None:
+        queue = music_queues[guild_id] = GuildQueue(on_change=lambda: state_store.mark_queue(guild_id))
+    return queue
+
+# --- Persistent State ---
+class StateStore:
+    # SQLite store for the allow-list, per-guild voice/engine/loudness settings and
+    # queues. The in-memory structures stay authoritative; commands only mark
+    # what changed, and a flusher task writes everything dirty once per
+    # STATE_FLUSH_INTERVAL in a single transaction on an executor thread.
+    # In cluster mode every worker shares the file: guilds belong to exactly
+    # one worker, and allow-list changes are written as deltas and picked up
+    # by the other workers through a version counter.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.user_changes = {}  # user_id -> True if added, False if removed
+        self.users_version = None
+        self.dirty_settings = set()
+        self.dirty_queues = set()
+        self.task = None
+        self.writes = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS allowed_users (user_id INTEGER PRIMARY KEY)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS guild_settings (guild_id INTEGER PRIMARY KEY, voice TEXT, engine TEXT)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(guild_settings)")}
+        if 'loudness' not in columns:
+            self.conn.execute("ALTER TABLE guild_settings ADD COLUMN loudness REAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue_tracks ("
+            "guild_id INTEGER NOT NULL, position INTEGER NOT NULL, web_url TEXT NOT NULL, title TEXT, "
+            "PRIMARY KEY (guild_id, position))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        self._import_legacy_users()
+
+    def _import_legacy_users(self):
+        # One-time import of the allow-list from the old JSON file
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_users_imported'").fetchone():
+            return
+        users = []
+        if os.path.exists(ALLOWED_USERS_FILE):
+            try:
+                with open(ALLOWED_USERS_FILE, 'r') as f:
+                    users = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Could not read {ALLOWED_USERS_FILE}: {e}")
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", [(int(u),) for u in users])
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_users_imported', '1')")
+        if users:
+            print(f"Imported {len(users)} allowed users from {ALLOWED_USERS_FILE}")
+
+    def load_allowed_users(self):
+        with self.lock:
+            self.users_version = self._users_version()
+            return {row[0] for row in self.conn.execute("SELECT user_id FROM allowed_users")}
+
+    def _users_version(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _reload_users_if_changed(self):
+        # Returns the stored allow-list if another worker (or this one) changed it
+        with self.lock:
+            version = self._users_version()
+            if version == self.users_version:
+                return None
+            self.users_version = version
+            return {row[0] for row in self.conn.execute("SELECT user_id FROM allowed_users")}
+
+    def load_guild_settings(self):
+        # Returns (voices, engines, loudness), all guild_id -> value
+        voices, engines, loudness = {}, {}, {}
+        with self.lock:
+            rows = self.conn.execute("SELECT guild_id, voice, engine, loudness FROM guild_settings")
+            for guild_id, voice, engine, target in rows:
+                if voice:
+                    voices[guild_id] = voice
+                if engine:
+                    engines[guild_id] = engine
+                if target is not None:
+                    loudness[guild_id] = target
+        return voices, engines, loudness
+
+    def load_queues(self):
+        queues = {}
+        with self.lock:
+            rows = self.conn.execute("SELECT guild_id, web_url, title FROM queue_tracks ORDER BY guild_id, position")
+            for guild_id, web_url, title in rows:
+                queues.setdefault(guild_id, []).append(Track(web_url, title))
+        return queues
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def mark_user(self, user_id, allowed):
+        self.user_changes[user_id] = allowed
+
+    def mark_settings(self, guild_id):
+        self.dirty_settings.add(guild_id)
+
+    def mark_queue(self, guild_id):
+        self.dirty_queues.add(guild_id)
+
+    def _snapshot(self):
+        # Runs on the event loop, so the structures can't change while being copied
+        snapshot = {
+            'users': self.user_changes,
+            'settings': [
+                (g, guild_settings.get(g), guild_engines.get(g), guild_loudness.get(g)) for g in self.dirty_settings
+            ],
+            'queues': {},
+        }
+        for guild_id in self.dirty_queues:
+            q = music_queues.get(guild_id)
+            tracks = []
+            if q is not None:
+                # The interrupted track comes back first after a restart
+                if q.current is not None:
+                    tracks.append(q.current)
+                tracks.extend(q)
+            snapshot['queues'][guild_id] = [(t.web_url, t.title) for t in tracks]
+        self.user_changes = {}
+        self.dirty_settings = set()
+        self.dirty_queues = set()
+        return snapshot
+
+    def _write(self, snapshot):
+        with self.lock, self.conn:
+            for user_id, allowed in snapshot['users'].items():
+                if allowed:
+                    self.conn.execute("INSERT OR IGNORE INTO allowed_users (user_id) VALUES (?)", (user_id,))
+                else:
+                    self.conn.execute("DELETE FROM allowed_users WHERE user_id = ?", (user_id,))
+            if snapshot['users']:
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('users_version', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO guild_settings (guild_id, voice, engine, loudness) VALUES (?, ?, ?, ?)",
+                snapshot['settings']
+            )
+            for guild_id, tracks in snapshot['queues'].items():
+                self.conn.execute("DELETE FROM queue_tracks WHERE guild_id = ?", (guild_id,))
+                self.conn.executemany(
+                    "INSERT INTO queue_tracks (guild_id, position, web_url, title) VALUES (?, ?, ?, ?)",
+                    [(guild_id, i, web_url, title) for i, (web_url, title) in enumerate(tracks)]
+                )
+            self.writes += 1
+
+    def has_changes(self):
+        return bool(self.user_changes) or bool(self.dirty_settings) or bool(self.dirty_queues)
+
+    def _restore_dirty(self, snapshot):
+        # A failed write is retried with the next flush
+        self.user_changes = {**snapshot['users'], **self.user_changes}
+        self.dirty_settings.update(settings[0] for settings in snapshot['settings'])
+        self.dirty_queues.update(snapshot['queues'])
+
+    def _write_and_reload(self, snapshot):
+        if snapshot:
+            self._write(snapshot)
+        return self._reload_users_if_changed()
+
+    async def flush(self):
+        snapshot = self._snapshot() if self.has_changes() else None
+        try:
+            users = await asyncio.get_event_loop().run_in_executor(None, self._write_and_reload, snapshot)
+        except sqlite3.Error as e:
+            ERRORS_TOTAL.inc("state")
+            print(f"❌ Failed to save state: {e}")
+            if snapshot:
+                self._restore_dirty(snapshot)
+            return
+        if users is not None:
+            # Keep the same set object; changes made since the snapshot still apply
+            allowed_users.clear()
+            allowed_users.update(users)
+            for user_id, allowed in self.user_changes.items():
+                if allowed:
+                    allowed_users.add(user_id)
+                else:
+                    allowed_users.discard(user_id)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def close(self):
+        # Final synchronous flush at shutdown, once the loop has stopped
+        if self.task:
+            self.task.cancel()
+        if self.has_changes():
+            self._write(self._snapshot())
+        self.conn.close()
 
-def save_allowed_users(users):
-    with open(ALLOWED_USERS_FILE, 'w') as f:
-        json.dump(users, f)
+state_store = StateStore(STATE_FILE)
 
-allowed_users = load_allowed_users()
+def restore_state():
+    voices, engines, loudness = state_store.load_guild_settings()
+    guild_settings.update(voices)
+    guild_engines.update(engines)
+    guild_loudness.update(loudness)
+    for guild_id, tracks in state_store.load_queues().items():
+        get_queue(guild_id).extend(tracks)
+    # Restoring went through the normal queue methods; nothing new to write yet
+    state_store.dirty_queues.clear()
+    if music_queues:
+        print(f"Restored queues for {len(music_queues)} guilds")
+
+allowed_users = state_store.load_allowed_users()
+restore_state()
 
 # --- Access Control Check ---
 def is_allowed(interaction: discord.Interaction) -> bool:
@@ -120,124 +877,2249 @@ VOICES = [
     app_commands.Choice(name="🇨🇳 Xiaoxiao (Multilingual Female)", value="zh-CN-XiaoxiaoMultilingualNeural"),
 ]
 
-# YT-DLP Options
-YTDL_OPTIONS = {
-    'format': 'bestaudio/best',
-    'noplaylist': True, # We handle playlists manually
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0',
-}
+FFMPEG_OPTIONS = {
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn',
+}
+
+# Size of one 20ms frame of 48kHz stereo s16le PCM
+FRAME_SIZE = 3840
+
+# ffmpeg command line for decoding TTS clips from stdin to raw PCM.
+# The input part depends on the engine; the default lets ffmpeg probe (MP3).
+TTS_INPUT_ARGS = ['-i', 'pipe:0']
+TTS_OUTPUT_ARGS = [
+    '-f', 's16le',
+    '-ar', '48000',
+    '-ac', '2',
+    '-loglevel', 'quiet',
+    'pipe:1'
+]
+
+# --- Decoder Pool ---
+# Idle ffmpeg processes kept ready, and the cap on decoders running at once
+DECODER_WARM_SIZE = int(os.getenv("DECODER_WARM_SIZE", 2))
+DECODER_MAX_ACTIVE = int(os.getenv("DECODER_MAX_ACTIVE", 8))
+DECODER_ACQUIRE_TIMEOUT = 30
+
+def spawn_tts_decoder(input_args=TTS_INPUT_ARGS):
+    return subprocess.Popen(
+        ['ffmpeg', *input_args, *TTS_OUTPUT_ARGS],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+
+class DecoderPool:
+    # Keeps pre-spawned ffmpeg processes waiting on stdin, so a clip gets a
+    # decoder without paying fork/exec on the request path. Each process still
+    # decodes a single clip; the pool refills in the background. When all
+    # slots are busy, waiting guilds are served round-robin.
+    def __init__(self, warm_size, max_active):
+        self.warm_size = warm_size
+        self.max_active = max_active
+        self.idle = deque()
+        self.active = 0
+        self.cond = threading.Condition()
+        self.waiters = OrderedDict()  # guild_id -> deque of tickets, in round-robin order
+        self.refilling = False
+        self.closed = False
+        self.spawned = 0
+        self.warm_hits = 0
+        self.cold_spawns = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Waiters each block a thread for up to DECODER_ACQUIRE_TIMEOUT; they get
+        # their own threads so a /say burst can't starve the default executor
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_active * 4, thread_name_prefix="decoder-wait"
+        )
+
+    async def acquire_async(self, guild_id, input_args=TTS_INPUT_ARGS):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.acquire, guild_id, input_args)
+
+    def acquire(self, guild_id, input_args=TTS_INPUT_ARGS, timeout=DECODER_ACQUIRE_TIMEOUT):
+        # Blocking; call from an executor (see acquire_async), never from the event loop.
+        # Pre-spawned decoders only take the default input; others count
+        # against the cap but are spawned on demand.
+        with self.cond:
+            if self.active >= self.max_active or self.waiters:
+                ticket = {'granted': False}
+                self.waiters.setdefault(guild_id, deque()).append(ticket)
+                started = time.monotonic()
+                granted = self.cond.wait_for(lambda: ticket['granted'], timeout)
+                waited = time.monotonic() - started
+                self.waits += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                if not granted:
+                    self._drop_ticket(guild_id, ticket)
+                    raise TimeoutError("All decoders are busy")
+            else:
+                self.active += 1
+
+            process = None
+            while self.idle and input_args == TTS_INPUT_ARGS:
+                candidate = self.idle.popleft()
+                if candidate.poll() is None:
+                    process = candidate
+                    self.warm_hits += 1
+                    break
+
+        if process is None:
+            try:
+                process = spawn_tts_decoder(input_args)
+            except Exception:
+                # Out of processes or memory: the slot we hold must not leak with it
+                self.release()
+                raise
+            with self.cond:
+                self.spawned += 1
+                self.cold_spawns += 1
+        self._schedule_refill()
+        return process
+
+    def _drop_ticket(self, guild_id, ticket):
+        tickets = self.waiters.get(guild_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.waiters[guild_id]
+
+    def release(self):
+        with self.cond:
+            if self.waiters:
+                # Hand the slot to the next guild in turn, then move it to the back
+                guild_id, tickets = next(iter(self.waiters.items()))
+                tickets.popleft()['granted'] = True
+                del self.waiters[guild_id]
+                if tickets:
+                    self.waiters[guild_id] = tickets
+                self.cond.notify_all()
+            else:
+                self.active -= 1
+
+    def _schedule_refill(self):
+        with self.cond:
+            if self.refilling or self.closed or len(self.idle) >= self.warm_size:
+                return
+            self.refilling = True
+        threading.Thread(target=self._refill, daemon=True).start()
+
+    def _refill(self):
+        try:
+            while True:
+                with self.cond:
+                    if self.closed or len(self.idle) >= self.warm_size:
+                        return
+                try:
+                    process = spawn_tts_decoder()
+                except OSError as e:
+                    print(f"Failed to pre-spawn decoder: {e}")
+                    return
+                with self.cond:
+                    self.spawned += 1
+                    self.idle.append(process)
+        finally:
+            with self.cond:
+                self.refilling = False
+
+    def warm_up(self):
+        if shutil.which("ffmpeg"):
+            self._schedule_refill()
+
+    def shutdown(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+        for process in idle:
+            process.kill()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'idle': len(self.idle),
+                'active': self.active,
+                'max_active': self.max_active,
+                'queued': sum(len(t) for t in self.waiters.values()),
+                'spawned': self.spawned,
+                'warm_hits': self.warm_hits,
+                'cold_spawns': self.cold_spawns,
+                'waits': self.waits,
+                'wait_avg': self.wait_total / self.waits if self.waits else 0.0,
+                'wait_max': self.wait_max,
+            }
+
+decoder_pool = DecoderPool(DECODER_WARM_SIZE, DECODER_MAX_ACTIVE)
+
+class SpeechSource(discord.AudioSource):
+    # Base for /say sources; reports time to first frame once say() sets requested_at
+    requested_at = None
+
+    def _mark_first_frame(self):
+        if self.requested_at is not None:
+            FIRST_FRAME_SECONDS.observe("speech", value=time.monotonic() - self.requested_at)
+            self.requested_at = None
+
+class CachedPCMAudioSource(SpeechSource):
+    # Plays already-decoded frames from the TTS cache. Frames are shared
+    # immutable bytes objects, so each read() hands one out without copying.
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def read(self):
+        if self.index >= len(self.frames):
+            return b''
+        ret = self.frames[self.index]
+        self.index += 1
+        self._mark_first_frame()
+        return ret
+
+    def cancel(self):
+        self.index = len(self.frames)
+
+# --- Chunked TTS ---
+# gTTS requests at most ~100 characters at a time anyway, sequentially;
+# we split the same way but synthesize the pieces in parallel
+TTS_CHUNK_CHARS = 100
+TTS_SYNTH_WORKERS = int(os.getenv("TTS_SYNTH_WORKERS", 4))
+# Decoded frames buffered ahead of the player (50 frames = 1 second)
+TTS_FRAME_BUFFER = 50
+SILENCE_FRAME = b'\x00' * FRAME_SIZE
+
+tts_executor = concurrent.futures.ThreadPoolExecutor(max_workers=TTS_SYNTH_WORKERS, thread_name_prefix="tts")
+
+# guild_id -> speech source currently playing, cancelled by /stop or the next /say
+active_speech = {}
+
+def split_tts_text(text, max_chars=TTS_CHUNK_CHARS):
+    # Sentences first, then clauses, then words for anything still too long
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?…])\s+', text.strip()):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in re.split(r'(?<=[,;:—])\s+', sentence):
+            while len(clause) > max_chars:
+                cut = clause.rfind(' ', 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(clause[:cut])
+                clause = clause[cut:].lstrip()
+            pieces.append(clause)
+
+    # Merge short neighbours back together so we don't make a request per word
+    chunks = []
+    for piece in pieces:
+        if not piece:
+            continue
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] += " " + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+class SpeechChunk:
+    # One piece of a message being synthesized. Engines push audio bytes in
+    # as they arrive, so the decoder can start before the chunk is complete.
+    def __init__(self, text):
+        self.text = text
+        self.pieces = Queue()
+        # Resolves once the first audio bytes arrive, or fails with the engine error
+        self.first = concurrent.futures.Future()
+        self.job = None
+        self.cancelled = False
+        # Set if synthesis failed part-way; the chunk's audio is then incomplete
+        self.error = None
+
+    def write(self, data):
+        if self.cancelled:
+            raise ChunkCancelled()
+        if not data:
+            return
+        self.pieces.put(data)
+        if not self.first.done():
+            self.first.set_result(True)
+
+    def finish(self, error=None):
+        self.error = error
+        if not self.first.done():
+            self.first.set_exception(error or Exception("No audio data generated"))
+        self.pieces.put(None)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.job and self.job.cancel():
+            # The job never ran, so nobody else will end the chunk
+            self.finish(ChunkCancelled())
+
+    def iter_pieces(self):
+        while True:
+            piece = self.pieces.get()
+            if piece is None:
+                return
+            yield piece
+
+class ChunkCancelled(Exception):
+    pass
+
+class _WriteSink:
+    # File-like adapter for engines that write to a file object
+    def __init__(self, write):
+        self.write = write
+
+# --- TTS Engines ---
+class TTSEngine:
+    name = None
+    label = None
+    # Remote engines fall back to the local one when slow or failing
+    remote = True
+    uses_voice = False
+    max_chunk_chars = 100
+    ffmpeg_input_args = TTS_INPUT_ARGS
+
+    def available(self):
+        return True
+
+    def cache_voice(self, voice):
+        # Everything besides the text that changes the audio, for the TTS cache key
+        return voice if self.uses_voice else ""
+
+    def synthesize(self, text, voice, write):
+        # Blocking; calls write(bytes) for each piece of audio as it arrives
+        raise NotImplementedError
+
+class GTTSEngine(TTSEngine):
+    name = "gtts"
+    label = "Google TTS"
+
+    def cache_voice(self, voice):
+        return GTTS_LANG
+
+    def synthesize(self, text, voice, write):
+        from gtts import gTTS
+
+        # gTTS uses language codes, not voice names
+        tts = gTTS(text=text, lang=GTTS_LANG, slow=False)
+        tts.write_to_fp(_WriteSink(write))
+
+class EdgeTTSEngine(TTSEngine):
+    name = "edge"
+    label = "Edge TTS (нейросетевые голоса)"
+    uses_voice = True
+    max_chunk_chars = 300
+
+    def available(self):
+        return EDGE_TTS_INSTALLED
+
+    def synthesize(self, text, voice, write):
+        import edge_tts
+
+        async def stream():
+            communicate = edge_tts.Communicate(text, voice)
+            async for message in communicate.stream():
+                if message['type'] == 'audio':
+                    write(message['data'])
+
+        # Runs on a TTS executor thread, which has no event loop of its own
+        asyncio.run(stream())
+
+class LocalTTSEngine(TTSEngine):
+    # espeak-ng: no network, near-instant, robotic but always there
+    name = "local"
+    label = "Локальный (espeak-ng, без интернета)"
+    remote = False
+    max_chunk_chars = 200
+    sample_rate = 22050
+    ffmpeg_input_args = ['-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0']
+
+    def binary(self):
+        return shutil.which("espeak-ng") or shutil.which("espeak")
+
+    def available(self):
+        return self.binary() is not None
+
+    def cache_voice(self, voice):
+        return LOCAL_TTS_VOICE
+
+    def synthesize(self, text, voice, write):
+        result = subprocess.run(
+            [self.binary(), '--stdout', '--stdin', '-v', LOCAL_TTS_VOICE],
+            input=text.encode('utf-8'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+            check=True
+        )
+        rate, channels, pcm = wav_pcm_payload(result.stdout)
+        if rate != self.sample_rate or channels != 1:
+            raise Exception(f"Unexpected espeak output: {rate} Hz, {channels} channels")
+        # Raw PCM (not WAV) so chunks can be concatenated into one decoder input
+        write(pcm)
+
+def wav_pcm_payload(data):
+    # espeak writes placeholder sizes when streaming, so only trust the chunk layout
+    rate = channels = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = int.from_bytes(data[pos + 4:pos + 8], 'little')
+        if chunk_id == b'fmt ':
+            channels = int.from_bytes(data[pos + 10:pos + 12], 'little')
+            rate = int.from_bytes(data[pos + 12:pos + 16], 'little')
+        elif chunk_id == b'data':
+            return rate, channels, data[pos + 8:]
+        pos += 8 + size + (size & 1)
+    raise Exception("No audio data in WAV output")
+
+# Checked without importing it
+EDGE_TTS_INSTALLED = importlib.util.find_spec("edge_tts") is not None
+
+TTS_ENGINES = {engine.name: engine for engine in (EdgeTTSEngine(), GTTSEngine(), LocalTTSEngine())}
+
+# engine name -> time.monotonic() of its last failure or budget overrun
+engine_failures = {}
+
+def get_engine(guild_id):
+    engine = TTS_ENGINES.get(guild_engines.get(guild_id, DEFAULT_TTS_ENGINE))
+    if engine is None or not engine.available():
+        engine = TTS_ENGINES['gtts']
+    return engine
+
+def engine_healthy(engine):
+    failed_at = engine_failures.get(engine.name)
+    return failed_at is None or time.monotonic() - failed_at > TTS_ENGINE_COOLDOWN
+
+def _run_chunk(engine, chunk, voice):
+    if chunk.cancelled:
+        chunk.finish(ChunkCancelled())
+        return
+    try:
+        engine.synthesize(chunk.text, voice, chunk.write)
+    except ChunkCancelled as e:
+        chunk.finish(e)
+    except Exception as e:
+        print(f"TTS chunk failed ({engine.name}): {e}")
+        chunk.finish(e)
+    else:
+        chunk.finish()
+
+def start_synthesis(engine, text, voice):
+    chunks = [SpeechChunk(piece) for piece in split_tts_text(text, engine.max_chunk_chars)]
+    for chunk in chunks:
+        chunk.job = tts_executor.submit(_run_chunk, engine, chunk, voice)
+    return chunks
+
+async def synthesize_speech(guild_id, text, voice):
+    # Returns (engine, chunks) once the first chunk has audio. A remote engine
+    # that errors or misses the latency budget is swapped for the local one.
+    started = time.monotonic()
+    engine = get_engine(guild_id)
+    local = TTS_ENGINES['local']
+    can_fall_back = engine.remote and local.available()
+    if can_fall_back and not engine_healthy(engine):
+        print(f"TTS engine {engine.name} failed recently, using {local.name}")
+        engine = local
+
+    chunks = start_synthesis(engine, text, voice)
+    if not chunks:
+        raise Exception("Nothing to say")
+    if not (engine.remote and can_fall_back):
+        await asyncio.wrap_future(chunks[0].first)
+        TTS_GENERATION_SECONDS.observe(engine.name, value=time.monotonic() - started)
+        return engine, chunks
+
+    try:
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(chunks[0].first)), TTS_LATENCY_BUDGET)
+        engine_failures.pop(engine.name, None)
+        TTS_GENERATION_SECONDS.observe(engine.name, value=time.monotonic() - started)
+        return engine, chunks
+    except Exception as e:
+        reason = "timed out" if isinstance(e, asyncio.TimeoutError) else e
+        print(f"TTS engine {engine.name} {reason}, falling back to {local.name}")
+        ERRORS_TOTAL.inc(f"tts_{engine.name}")
+        engine_failures[engine.name] = time.monotonic()
+        for chunk in chunks:
+            chunk.cancel()
+
+    chunks = start_synthesis(local, text, voice)
+    await asyncio.wrap_future(chunks[0].first)
+    TTS_GENERATION_SECONDS.observe(local.name, value=time.monotonic() - started)
+    return local, chunks
+
+class ChunkedTTSAudioSource(SpeechSource):
+    # Plays chunks in order while later ones are still being synthesized.
+    # All chunk audio goes into a single ffmpeg stdin, so joins are gapless and
+    # there is one decoder per message. A writer thread feeds the chunks in as
+    # they arrive and a reader thread keeps a small frame buffer; if synthesis
+    # falls behind, read() returns silence instead of stalling the player thread.
+    def __init__(self, chunks, on_complete=None, process=None, pool=None, max_frames=None):
+        self.chunks = chunks
+        # A decoder handed out by DecoderPool, released back to it in cleanup()
+        self.ffmpeg_process = process
+        self.pool = pool
+        self.writer_thread = None
+        self.reader_thread = None
+        self.frame_queue = Queue(maxsize=TTS_FRAME_BUFFER)
+        self.finished = False
+        self.cancelled = False
+        self.underruns = 0
+        # Called with the list of decoded frames once the clip played to the end;
+        # a clip longer than max_frames is not kept, so memory stays bounded
+        self.on_complete = on_complete
+        self.frames = [] if on_complete else None
+        self.max_frames = max_frames
+        # Set when some audio was lost; such a clip must not reach on_complete
+        self.failed = False
+
+    def _start(self):
+        if self.ffmpeg_process is None:
+            self.ffmpeg_process = spawn_tts_decoder()
+        self.decode_started = time.monotonic()
+        self.writer_thread = threading.Thread(target=self._feed, args=(self.ffmpeg_process,), daemon=True)
+        self.writer_thread.start()
+        self.reader_thread = threading.Thread(target=self._read_frames, args=(self.ffmpeg_process,), daemon=True)
+        self.reader_thread.start()
+
+    def _feed(self, process):
+        try:
+            # A failed chunk just ends early; the rest of the message still plays,
+            # but isn't cached
+            for chunk in self.chunks:
+                for piece in chunk.iter_pieces():
+                    if self.cancelled:
+                        return
+                    process.stdin.write(piece)
+                if chunk.error is not None:
+                    self.failed = True
+        except (BrokenPipeError, OSError, ValueError):
+            self.failed = True
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def _put(self, item):
+        while not self.cancelled:
+            try:
+                self.frame_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_frames(self, process):
+        first = True
+        try:
+            while True:
+                data = process.stdout.read(FRAME_SIZE)
+                if not data:
+                    break
+                if first:
+                    first = False
+                    FFMPEG_DECODE_SECONDS.observe(value=time.monotonic() - self.decode_started)
+                if len(data) < FRAME_SIZE:
+                    data += b'\x00' * (FRAME_SIZE - len(data))
+                if not self._put(data):
+                    return
+            if process.wait() != 0:
+                # ffmpeg gave up on the input part-way
+                self.failed = True
+        except (OSError, ValueError):
+            self.failed = True
+        self._put(None)
+
+    def read(self):
+        if self.finished:
+            return b''
+        if self.writer_thread is None:
+            self._start()
+
+        try:
+            ret = self.frame_queue.get(timeout=0.015)
+        except Empty:
+            self.underruns += 1
+            return SILENCE_FRAME
+        if ret is None:
+            self._finish()
+            return b''
+        self._mark_first_frame()
+        if self.frames is not None:
+            self.frames.append(ret)
+            if self.max_frames is not None and len(self.frames) > self.max_frames:
+                # Too long to cache: stop holding the decoded clip
+                self.frames = None
+                self.on_complete = None
+        return ret
+
+    def _finish(self):
+        self.finished = True
+        if self.on_complete and self.frames and not self.failed:
+            try:
+                self.on_complete(self.frames)
+            except Exception as e:
+                print(f"TTS complete callback failed: {e}")
+        self.on_complete = None
+
+    def cancel(self):
+        self.cancelled = True
+        self.finished = True
+        self.on_complete = None
+        for chunk in self.chunks:
+            chunk.cancel()
+
+    def cleanup(self):
+        self.cancel()
+        process = self.ffmpeg_process
+        if process:
+            process.kill()
+            try:
+                process.stdout.close()
+            except OSError:
+                pass
+            process.wait()
+        for thread in (self.writer_thread, self.reader_thread):
+            if thread and thread is not threading.current_thread():
+                thread.join(timeout=1)
+        if self.pool:
+            pool, self.pool = self.pool, None
+            pool.release()
+
+def cancel_speech(guild_id):
+    source = active_speech.pop(guild_id, None)
+    if source:
+        source.cancel()
+
+# --- Speech Over Music ---
+# Music volume while speech is playing, and how fast it ramps (gain change per frame)
+DUCK_GAIN = float(os.getenv("DUCK_GAIN", 0.3))
+DUCK_STEP = 0.25
+
+class MixingAudioSource(discord.AudioSource):
+    # Wraps the music source and overlays speech frames on top of it, so /say
+    # never has to stop (and thereby skip) the current track.
+    # If the music is Opus, packets pass straight through untouched; only while
+    # speech is playing are they decoded to PCM, mixed and encoded again here.
+    # The output format never changes mid-track: discord.py only creates its own
+    # encoder if the source wasn't Opus when play() was called.
+    def __init__(self, music, level=1.0):
+        self.music = music
+        # Linear loudness correction for sources ffmpeg can't apply it to (cached Opus)
+        self.level = level
+        self.music_opus = music.is_opus()
+        # With a loudness correction every frame is decoded and scaled anyway, so
+        # hand out PCM from the start and let the voice client's encoder do the rest
+        self.output_opus = self.music_opus and level == 1.0
+        self.decoder = None
+        self.encoder = None
+        self.overlays = deque()
+        self.gain = 1.0
+        self.music_done = False
+        # Music frames handed out so far (20 ms each); play_next uses it to
+        # resume a dropped stream at the right position
+        self.frames = 0
+        # Set by play_next; the first music frame reports time to first frame
+        self.requested_at = None
+
+    def can_mix(self):
+        # Mixing Opus music needs libopus to decode it
+        return not self.music_opus or discord.opus.is_loaded()
+
+    def add_overlay(self, source):
+        self.overlays.append(source)
+
+    def is_opus(self):
+        return self.output_opus
+
+    def _output(self, pcm):
+        # Mixed PCM out, in the format the player was started with
+        if not self.output_opus:
+            return pcm
+        if self.encoder is None:
+            self.encoder = discord.opus.Encoder()
+        return self.encoder.encode(pcm, discord.opus.Encoder.SAMPLES_PER_FRAME)
+
+    def _next_overlay_frame(self):
+        while self.overlays:
+            source = self.overlays[0]
+            frame = source.read()
+            if frame:
+                return frame
+            self.overlays.popleft()
+            source.cleanup()
+        return None
+
+    def read(self):
+        frame = b'' if self.music_done else self.music.read()
+        if not frame:
+            self.music_done = True
+        else:
+            self.frames += 1
+            if self.requested_at is not None:
+                FIRST_FRAME_SECONDS.observe("music", value=time.monotonic() - self.requested_at)
+                self.requested_at = None
+
+        speech = self._next_overlay_frame()
+        target = DUCK_GAIN if speech else 1.0
+
+        if not frame:
+            # Music ended; let the remaining speech finish on its own
+            return self._output(speech) if speech else b''
+
+        if speech is None and self.gain == 1.0 and self.level == 1.0:
+            return frame
+
+        if self.music_opus:
+            if self.decoder is None:
+                self.decoder = discord.opus.Decoder()
+            frame = self.decoder.decode(frame)
+            if len(frame) != FRAME_SIZE:
+                # Only 20 ms packets can be mixed frame-for-frame
+                frame = frame[:FRAME_SIZE].ljust(FRAME_SIZE, b'\x00')
+
+        # Ramp the gain across the frame to avoid clicks when ducking starts/stops
+        next_gain = max(target, self.gain - DUCK_STEP) if target < self.gain else min(target, self.gain + DUCK_STEP)
+        ramp = np.linspace(self.gain * self.level, next_gain * self.level, FRAME_SIZE // 4, dtype=np.float32).repeat(2)
+        self.gain = next_gain
+
+        mixed = np.frombuffer(frame, dtype=np.int16) * ramp
+        if speech is not None:
+            mixed += np.frombuffer(speech, dtype=np.int16)
+        # Clip instead of letting int16 wrap around
+        np.clip(mixed, -32768, 32767, out=mixed)
+        return self._output(mixed.astype(np.int16).tobytes())
+
+    def cleanup(self):
+        self.music.cleanup()
+        while self.overlays:
+            self.overlays.popleft().cleanup()
+
+# --- TTS Cache ---
+class TTSCache:
+    # Content-addressed cache of decoded TTS clips: (text, engine, voice) -> PCM frames.
+    # Memory tier is an LRU bounded by bytes, disk tier is optional and also bounded:
+    # files are evicted least recently used first, by mtime, which hits refresh.
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        # Largest clip either tier keeps; one huge clip must not flush the whole cache
+        self.max_entry_bytes = max_bytes // 4
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()  # key -> list of frames
+        self.size = 0
+        self.disk_entries = OrderedDict()  # key -> file size, oldest first
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        # Rebuild the disk LRU from what earlier runs left behind
+        files = []
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.pcm'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, entry.name[:-len('.pcm')], st.st_size))
+        for _, key, nbytes in sorted(files):
+            self.disk_entries[key] = nbytes
+            self.disk_size += nbytes
+        self._evict_disk()
+
+    @staticmethod
+    def make_key(text, engine, voice):
+        normalized = " ".join(text.split()).casefold()
+        return hashlib.sha256(f"{engine}\0{voice}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pcm")
+
+    def get(self, key):
+        with self.lock:
+            frames = self.entries.get(key)
+            if frames is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return frames
+
+        if self.disk_dir:
+            try:
+                path = self._disk_path(key)
+                with open(path, 'rb') as f:
+                    data = memoryview(f.read())
+                frames = [data[i:i + FRAME_SIZE].tobytes() for i in range(0, len(data), FRAME_SIZE)]
+                # Mark it recently used, for this process and for the next startup scan
+                os.utime(path)
+                with self.lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    if key in self.disk_entries:
+                        self.disk_entries.move_to_end(key)
+                self._insert(key, frames)
+                return frames
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"TTS cache read failed: {e}")
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, frames):
+        if len(frames) * FRAME_SIZE > self.max_entry_bytes:
+            return
+        self._insert(key, frames)
+        if self.disk_dir:
+            # Write to a temp file first so a crash never leaves a truncated clip
+            path = self._disk_path(key)
+            tmp_path = f"{path}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.writelines(frames)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"TTS cache write failed: {e}")
+                return
+            nbytes = len(frames) * FRAME_SIZE
+            with self.lock:
+                self.disk_size += nbytes - self.disk_entries.pop(key, 0)
+                self.disk_entries[key] = nbytes
+            self._evict_disk()
+
+    def _evict_disk(self):
+        while True:
+            with self.lock:
+                if self.disk_size <= self.disk_max_bytes or not self.disk_entries:
+                    return
+                key, nbytes = self.disk_entries.popitem(last=False)
+                self.disk_size -= nbytes
+                self.disk_evictions += 1
+            try:
+                os.remove(self._disk_path(key))
+            except FileNotFoundError:
+                # Another cluster worker sharing the directory got there first
+                pass
+            except OSError as e:
+                print(f"TTS cache eviction failed: {e}")
+
+    def _insert(self, key, frames):
+        nbytes = len(frames) * FRAME_SIZE
+        if nbytes > self.max_entry_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old) * FRAME_SIZE
+            self.entries[key] = frames
+            self.size += nbytes
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted) * FRAME_SIZE
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_size,
+                'disk_max_bytes': self.disk_max_bytes,
+                'disk_evictions': self.disk_evictions,
+            }
+
+tts_cache = TTSCache(TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR, TTS_CACHE_DISK_MAX_BYTES)
+
+# --- Extraction Metadata Cache ---
+class ExtractCache:
+    # SQLite cache for yt-dlp results. Flat playlist listings and track metadata
+    # live for METADATA_TTL, stream URLs only until they expire.
+    def __init__(self, path, metadata_ttl, max_entries):
+        self.path = path
+        self.metadata_ttl = metadata_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            "url TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "web_url TEXT PRIMARY KEY, title TEXT, duration REAL, webpage_url TEXT, fetched_at REAL NOT NULL, "
+            "stream_url TEXT, stream_expires_at REAL, last_used REAL NOT NULL)"
+        )
+        # Added after the first release; older cache files lack the column
+        try:
+            self.conn.execute("ALTER TABLE tracks ADD COLUMN acodec TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self.conn.commit()
+
+    def get_listing(self, url):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM listings WHERE url = ? AND fetched_at > ?",
+                (url, now - self.metadata_ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE listings SET last_used = ? WHERE url = ?", (now, url))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put_listing(self, url, data):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings (url, data, fetched_at, last_used) VALUES (?, ?, ?, ?)",
+                (url, json.dumps(data), now, now)
+            )
+            self._evict("listings")
+            self.conn.commit()
+
+    def get_stream(self, web_url):
+        # Returns (stream_url, expires_at, acodec, duration) if the stored URL is still usable
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT stream_url, stream_expires_at, acodec, duration FROM tracks WHERE web_url = ? AND stream_expires_at > ?",
+                (web_url, now + STREAM_URL_EXPIRY_MARGIN)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE tracks SET last_used = ? WHERE web_url = ?", (now, web_url))
+            self.conn.commit()
+        return row[0], row[1], row[2], row[3]
+
+    def put_track(self, web_url, data, stream_url, expires_at):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tracks "
+                "(web_url, title, duration, webpage_url, fetched_at, stream_url, stream_expires_at, last_used, acodec) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (web_url, data.get('title'), data.get('duration'), data.get('webpage_url', web_url),
+                 now, stream_url, expires_at, now, data.get('acodec'))
+            )
+            self._evict("tracks")
+            self.conn.commit()
+
+    def _evict(self, table):
+        # Keep each table under max_entries, dropping least recently used rows
+        key = "url" if table == "listings" else "web_url"
+        count = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                f"DELETE FROM {table} WHERE {key} IN "
+                f"(SELECT {key} FROM {table} ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def purge(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM listings")
+            self.conn.execute("DELETE FROM tracks")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+
+    def stats(self):
+        with self.lock:
+            listings = self.conn.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            tracks = self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {
+            'listings': listings,
+            'tracks': tracks,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+extract_cache = ExtractCache(EXTRACT_CACHE_FILE, EXTRACT_CACHE_METADATA_TTL, EXTRACT_CACHE_MAX_ENTRIES)
+
+# --- Admission Control ---
+# Budgets for the expensive things a burst of commands can pile up: music
+# streams (one ffmpeg each) and yt-dlp extractions. Work over budget waits
+# its turn instead of everyone slowing down at once. Waiters are served by
+# priority, and round-robin across guilds within a priority, so one guild's
+# 500-track playlist can't starve the others. (TTS decoders have their own
+# budget in DecoderPool.)
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", 16))
+# 0 means no limit on how many guilds the bot joins at once
+MAX_VOICE_CONNECTIONS = int(os.getenv("MAX_VOICE_CONNECTIONS", 0))
+
+# Lower runs first
+PRIORITY_PLAYBACK = 0     # the track a guild is about to hear
+PRIORITY_INTERACTIVE = 1  # a user waiting on /play
+PRIORITY_PREFETCH = 2     # resolving upcoming tracks ahead of time
+PRIORITY_PLAYLIST = 3     # background playlist import
+
+ADMISSION_WAIT_SECONDS = metrics.register(Histogram(
+    "voicebot_admission_wait_seconds", "Time spent waiting for a resource budget", ("resource",)))
+
+class ResourceBudget:
+    # Used from the event loop only; release from other threads via call_soon_threadsafe
+    def __init__(self, name, capacity, per_guild=None):
+        self.name = name
+        self.capacity = capacity
+        self.per_guild = per_guild
+        self.in_use = 0
+        self.guild_in_use = {}  # guild_id -> slots held
+        # priority -> OrderedDict guild_id -> deque of waiting futures
+        self.waiters = {}
+        self.waiting_tasks = {}  # task -> (priority, guild_id, future), for promote()
+        self.queued = 0
+        self.granted = 0
+
+    def _guild_full(self, guild_id):
+        return self.per_guild is not None and self.guild_in_use.get(guild_id, 0) >= self.per_guild
+
+    def waiting(self):
+        return sum(len(futures) for guilds in self.waiters.values() for futures in guilds.values())
+
+    def would_wait(self, guild_id):
+        # Free capacity with waiters left means those waiters are all at their guild cap
+        return self.in_use >= self.capacity or self._guild_full(guild_id)
+
+    def position(self, priority):
+        # How many waiters would be served before a new one at this priority
+        return sum(
+            len(futures) for p, guilds in self.waiters.items() if p <= priority for futures in guilds.values()
+        )
+
+    def _take(self, guild_id):
+        self.in_use += 1
+        self.guild_in_use[guild_id] = self.guild_in_use.get(guild_id, 0) + 1
+        self.granted += 1
+
+    async def acquire(self, guild_id, priority):
+        if not self.would_wait(guild_id):
+            self._take(guild_id)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(priority, guild_id, future)
+        task = asyncio.current_task()
+        self.waiting_tasks[task] = (priority, guild_id, future)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled
+                self.release(guild_id)
+            else:
+                self._discard(guild_id, future)
+            raise
+        finally:
+            self.waiting_tasks.pop(task, None)
+            ADMISSION_WAIT_SECONDS.observe(self.name, value=time.monotonic() - started)
+
+    def release(self, guild_id):
+        self.in_use -= 1
+        held = self.guild_in_use.get(guild_id, 0) - 1
+        if held > 0:
+            self.guild_in_use[guild_id] = held
+        else:
+            self.guild_in_use.pop(guild_id, None)
+        self._grant()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, guild_id, priority):
+        await self.acquire(guild_id, priority)
+        try:
+            yield
+        finally:
+            self.release(guild_id)
+
+    def promote(self, task, priority):
+        # Move a task that is still waiting to a more urgent priority
+        entry = self.waiting_tasks.get(task)
+        if entry is None or entry[0] <= priority:
+            return
+        old_priority, guild_id, future = entry
+        self._discard(guild_id, future, old_priority)
+        self._enqueue(priority, guild_id, future)
+        self.waiting_tasks[task] = (priority, guild_id, future)
+
+    def _enqueue(self, priority, guild_id, future):
+        guilds = self.waiters.setdefault(priority, OrderedDict())
+        guilds.setdefault(guild_id, deque()).append(future)
+
+    def _discard(self, guild_id, future, priority=None):
+        for p in ([priority] if priority is not None else list(self.waiters)):
+            guilds = self.waiters.get(p)
+            futures = guilds.get(guild_id) if guilds else None
+            if futures and future in futures:
+                futures.remove(future)
+                if not futures:
+                    del guilds[guild_id]
+                if not guilds:
+                    del self.waiters[p]
+                return
+
+    def _grant(self):
+        while self.in_use < self.capacity:
+            picked = self._next_waiter()
+            if picked is None:
+                return
+            guild_id, future = picked
+            self._take(guild_id)
+            future.set_result(None)
+
+    def _next_waiter(self):
+        for priority in sorted(self.waiters):
+            guilds = self.waiters[priority]
+            for guild_id in list(guilds):
+                if self._guild_full(guild_id):
+                    continue
+                futures = guilds.pop(guild_id)
+                future = futures.popleft()
+                # Back of the line for this guild's next waiter: round-robin
+                if futures:
+                    guilds[guild_id] = futures
+                if not guilds:
+                    del self.waiters[priority]
+                return guild_id, future
+        return None
+
+    def stats(self):
+        return {
+            'in_use': self.in_use,
+            'capacity': self.capacity,
+            'waiting': self.waiting(),
+            'queued': self.queued,
+            'granted': self.granted,
+        }
+
+stream_budget = ResourceBudget("streams", MAX_STREAMS)
+# Guilds whose next track is waiting for a stream slot; they aren't "playing" yet
+waiting_for_stream = set()
+
+metrics.register(Gauge(
+    "voicebot_admission_in_use", "Slots held per resource budget", ("resource",),
+    collect=lambda: {(b.name,): b.in_use for b in (stream_budget, extraction.budget)}
+))
+metrics.register(Gauge(
+    "voicebot_admission_waiting", "Requests waiting per resource budget", ("resource",),
+    collect=lambda: {(b.name,): b.waiting() for b in (stream_budget, extraction.budget)}
+))
+
+def voice_connection_available(guild):
+    # Joining a new guild needs a free connection slot; moving channels doesn't
+    if guild.voice_client or not MAX_VOICE_CONNECTIONS:
+        return True
+    return len(bot.voice_clients) < MAX_VOICE_CONNECTIONS
+
+async def notify_if_busy(interaction, budget, priority, what):
+    # Tell the user up front when their request has to wait for a slot
+    if budget.would_wait(interaction.guild_id):
+        ahead = budget.position(priority)
+        await interaction.followup.send(
+            f"⏳ Бот сейчас загружен: {what} в очереди (перед вами: {ahead}). Запустится автоматически.",
+            ephemeral=True
+        )
+        return True
+    return False
+
+# --- Extraction Service ---
+# yt-dlp parsing is CPU-heavy Python; running it in worker processes keeps it
+# off the GIL shared with the event loop and the audio player threads.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 2))
+EXTRACT_MAX_CONCURRENCY = int(os.getenv("EXTRACT_MAX_CONCURRENCY", 4))
+EXTRACT_PER_GUILD = int(os.getenv("EXTRACT_PER_GUILD", 2))
+EXTRACT_TIMEOUT = int(os.getenv("EXTRACT_TIMEOUT", 60))
+
+class ExtractionService:
+    def __init__(self, workers, max_concurrency, per_guild, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.per_guild = per_guild
+        self.pool = None
+        self.budget = ResourceBudget("extract", max_concurrency, per_guild=per_guild)
+        self.guild_tasks = {}   # guild_id -> set of running extract tasks
+
+    def _get_pool(self):
+        # Created lazily so importing main.py doesn't spawn processes.
+        # Never forked: see extract_worker.py
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=extract_worker.init_worker
+            )
+        return self.pool
+
+    async def extract(self, guild_id, url, flat=False, items=None, priority=PRIORITY_INTERACTIVE, timeout=None,
+                      cancellable=True):
+        # Work shared with other guilds passes cancellable=False, so this
+        # guild's /stop or /leave (cancel_guild) leaves it running
+        task = asyncio.current_task()
+        tasks = self.guild_tasks.setdefault(guild_id, set()) if cancellable else set()
+        tasks.add(task)
+        try:
+            async with self.budget.slot(guild_id, priority):
+                loop = asyncio.get_event_loop()
+                future = loop.run_in_executor(self._get_pool(), extract_worker.extract, url, flat, items)
+                started = time.monotonic()
+                try:
+                    result = await asyncio.wait_for(future, timeout=timeout or self.timeout)
+                except asyncio.TimeoutError:
+                    ERRORS_TOTAL.inc("extract_timeout")
+                    raise
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    ERRORS_TOTAL.inc("extract")
+                    raise
+                EXTRACT_SECONDS.observe("flat" if flat else "full", value=time.monotonic() - started)
+                return result
+        finally:
+            tasks.discard(task)
+
+    def promote(self, task, priority):
+        self.budget.promote(task, priority)
+
+    def warm_up(self):
+        # Start the workers, and their yt-dlp import, before the first /play needs them
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(int)
+
+    def cancel_guild(self, guild_id, keep=()):
+        # The worker finishes its current call, but the result is discarded.
+        # Tasks in keep (shared with other guilds) are left running
+        for task in list(self.guild_tasks.get(guild_id, ())):
+            if task not in keep:
+                task.cancel()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+extraction = ExtractionService(EXTRACT_WORKERS, EXTRACT_MAX_CONCURRENCY, EXTRACT_PER_GUILD, EXTRACT_TIMEOUT)
+
+# --- Stream Prefetching ---
+# Signed stream URLs (googlevideo etc.) carry an `expire` timestamp; others get a fixed TTL
+STREAM_URL_DEFAULT_TTL = 30 * 60
+# Re-resolve this many seconds before a URL actually expires
+STREAM_URL_EXPIRY_MARGIN = 60
+# How many upcoming queue entries to resolve while the current track plays.
+# Resolving them early also finds dead entries before their turn comes
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", 4))
+# yt-dlp errors that won't go away on a retry; such entries are dropped from the queue.
+# "Video unavailable" alone isn't one: YouTube also says it when rate limiting
+DEAD_TRACK_ERRORS = re.compile(r"private video|has been removed|terminated|copyright|members-only", re.IGNORECASE)
+TRANSIENT_ERRORS = re.compile(r"try again later|rate.?limit|too many requests|HTTP Error (429|5\d\d)", re.IGNORECASE)
+
+def is_dead_track_error(error):
+    message = str(error)
+    return DEAD_TRACK_ERRORS.search(message) is not None and TRANSIENT_ERRORS.search(message) is None
+
+# web_url -> (stream_url, expires_at, acodec, duration)
+resolved_streams = {}
+
+# web_url -> asyncio.Task resolving that url
+pending_resolves = {}
+
+# web_url -> guild_ids that need pending_resolves[web_url]. Tasks are shared
+# across guilds, so one guild's /stop only cancels those nobody else needs
+resolve_guilds = {}
+
+# guild_id -> time.monotonic() when the previous track ended
+track_ended_at = {}
+
+# guild_id -> {'last': float, 'total': float, 'count': int}
+gap_stats = {}
+
+def stream_url_expiry(stream_url):
+    # Wall-clock expiry, so it stays meaningful in the persistent cache
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(stream_url).query)
+    expire = query.get('expire')
+    if expire:
+        try:
+            return int(expire[0])
+        except ValueError:
+            pass
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+def get_fresh_stream(web_url):
+    cached = resolved_streams.get(web_url)
+    if cached and cached[1] - STREAM_URL_EXPIRY_MARGIN > time.time():
+        return cached
+    resolved_streams.pop(web_url, None)
+    return None
+
+async def _resolve_stream(guild_id, web_url, priority=PRIORITY_PLAYBACK, fresh=False):
+    loop = asyncio.get_event_loop()
+
+    if not fresh:
+        cached = await loop.run_in_executor(None, extract_cache.get_stream, web_url)
+        if cached:
+            resolved_streams[web_url] = cached
+            return cached
+
+    data = await extraction.extract(guild_id, web_url, priority=priority)
+
+    stream_url = data['url']
+    expires_at = stream_url_expiry(stream_url)
+    resolved = (stream_url, expires_at, data.get('acodec'), data.get('duration'))
+    resolved_streams[web_url] = resolved
+    await loop.run_in_executor(None, extract_cache.put_track, web_url, data, stream_url, expires_at)
+    return resolved
+
+async def resolve_stream(guild_id, web_url, fresh=False):
+    # Returns (stream_url, expires_at, acodec, duration).
+    # fresh=True skips every cached URL: used when the previous one just broke
+    if fresh:
+        resolved_streams.pop(web_url, None)
+        return await _resolve_stream(guild_id, web_url, fresh=True)
+    resolved = get_fresh_stream(web_url)
+    if resolved:
+        return resolved
+
+    while True:
+        # Share one in-flight extraction between play_next and the prefetcher
+        task = pending_resolves.get(web_url)
+        if task is None:
+            task = asyncio.ensure_future(_resolve_stream(guild_id, web_url))
+            pending_resolves[web_url] = task
+            task.add_done_callback(lambda t: _resolve_done(web_url))
+        else:
+            # A prefetch still waiting for an extraction slot is now needed right away
+            extraction.promote(task, PRIORITY_PLAYBACK)
+        guilds = resolve_guilds.setdefault(web_url, set())
+        guilds.add(guild_id)
+        try:
+            # shield: cancelling one waiter must not cancel the shared extraction
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled() or guild_id not in guilds:
+                # This waiter was cancelled, or this guild's /stop cancelled the extraction
+                raise
+            # Cancelled under us by another guild's /stop; start over
+
+def _resolve_done(web_url):
+    pending_resolves.pop(web_url, None)
+    resolve_guilds.pop(web_url, None)
+
+def schedule_prefetch(guild_id):
+    for track in get_queue(guild_id).peek(PREFETCH_AHEAD):
+        web_url = track.web_url
+        if web_url in pending_resolves:
+            resolve_guilds.setdefault(web_url, set()).add(guild_id)
+            continue
+        if get_fresh_stream(web_url):
+            continue
+        if track_cache and os.path.exists(track_cache.path(web_url)):
+            continue
+        task = asyncio.ensure_future(_resolve_stream(guild_id, web_url, PRIORITY_PREFETCH))
+        pending_resolves[web_url] = task
+        resolve_guilds.setdefault(web_url, set()).add(guild_id)
+        task.add_done_callback(lambda t, url=web_url: _prefetch_done(guild_id, url, t))
+
+def _prefetch_done(guild_id, web_url, task):
+    _resolve_done(web_url)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is None:
+        # Measured before its turn, so even the first play is normalized
+        analyze_loudness(guild_id, web_url, task.result()[0])
+        return
+    print(f"Prefetch failed for {web_url}: {error}")
+    if not is_dead_track_error(error):
+        # Timeouts, network errors, rate limits: play_next will simply try again
+        return
+    dropped = get_queue(guild_id).discard(web_url)
+    if dropped:
+        print(f"Dropped {dropped} unavailable queue entries: {web_url}")
+        ERRORS_TOTAL.inc("dead_track")
+        # The next entries moved up into the prefetch window
+        schedule_prefetch(guild_id)
+
+def shared_resolves(guild_id):
+    # Resolves this guild waits on that other guilds need as well
+    return {
+        pending_resolves[web_url] for web_url, guilds in resolve_guilds.items()
+        if guild_id in guilds and len(guilds) > 1 and web_url in pending_resolves
+    }
+
+def cancel_prefetch(guild_id):
+    for web_url, guilds in list(resolve_guilds.items()):
+        guilds.discard(guild_id)
+        task = pending_resolves.get(web_url)
+        if task and not guilds:
+            task.cancel()
+    for track in get_queue(guild_id):
+        resolved_streams.pop(track.web_url, None)
+    track_ended_at.pop(guild_id, None)
+
+def record_gap(guild_id):
+    ended = track_ended_at.pop(guild_id, None)
+    if ended is None:
+        return
+    gap = time.monotonic() - ended
+    TRACK_GAP_SECONDS.observe(value=gap)
+    stats = gap_stats.setdefault(guild_id, {'last': 0.0, 'total': 0.0, 'count': 0})
+    stats['last'] = gap
+    stats['total'] += gap
+    stats['count'] += 1
+    print(f"Track gap: {gap * 1000:.0f} ms (avg {stats['total'] / stats['count'] * 1000:.0f} ms)")
+
+# --- Playlist Ingestion ---
+# Entries fetched before playback starts; the rest is appended in batches
+PLAYLIST_FIRST_BATCH = 5
+PLAYLIST_BATCH_SIZE = 100
+# Listing the rest of a playlist is one yt-dlp call; with thousands of entries
+# it takes far longer than an interactive lookup, so it gets its own limit
+PLAYLIST_IMPORT_TIMEOUT = int(os.getenv("PLAYLIST_IMPORT_TIMEOUT", 600))
+
+# guild_id -> set of asyncio.Tasks ingesting the rest of a playlist
+playlist_imports = {}
+
+def enqueue_entries(guild_id, entries):
+    queue = get_queue(guild_id)
+    added_count = 0
+    for entry in entries:
+        title = entry.get('title', 'Unknown Track')
+        web_url = entry.get('url')
+        # For some extractors, url might be missing or different, handle accordingly
+        if not web_url:
+            web_url = entry.get('webpage_url')
+
+        if web_url:
+            queue.append(Track(web_url, title))
+            added_count += 1
+    return added_count
+
+def playlist_loading_text(added_count, total):
+    if total:
+        return f"📚 **Загружаю плейлист...** (уже в очереди: {added_count}, всего в плейлисте: {total})"
+    return f"📚 **Загружаю плейлист...** (уже в очереди: {added_count})"
+
+async def ingest_playlist(interaction, url, message, head, added_count):
+    guild_id = interaction.guild_id
+    try:
+        rest = await extraction.extract(
+            guild_id, url, flat=True, items=f"{PLAYLIST_FIRST_BATCH + 1}:", priority=PRIORITY_PLAYLIST,
+            timeout=PLAYLIST_IMPORT_TIMEOUT
+        )
+        entries = rest.get('entries', [])
+        total = head.get('total') or rest.get('total')
+
+        for i in range(0, len(entries), PLAYLIST_BATCH_SIZE):
+            added_count += enqueue_entries(guild_id, entries[i:i + PLAYLIST_BATCH_SIZE])
+            # Yield so a large playlist doesn't hold the event loop
+            await asyncio.sleep(0)
+
+        full = {'entries': head['entries'] + entries, 'count': head['count'] + rest.get('count', 0), 'total': total}
+        await asyncio.get_event_loop().run_in_executor(None, extract_cache.put_listing, url, full)
+        await message.edit(content=f"📚 **Плейлист добавлен!** ({added_count} треков)")
+
+        # Every head entry may have failed and drained the queue while we were loading
+        voice_client = interaction.guild.voice_client
+        if voice_client and not voice_client.is_playing() and guild_id not in waiting_for_stream and get_queue(guild_id):
+            await play_next(interaction)
+
+    except asyncio.CancelledError:
+        await message.edit(content=f"⏹️ Загрузка плейлиста отменена ({added_count} треков)")
+        raise
+    except asyncio.TimeoutError:
+        print(f"Playlist ingestion timed out for {url} after {PLAYLIST_IMPORT_TIMEOUT} s")
+        await message.edit(
+            content=f"⌛ Плейлист загружался слишком долго, добавлено только {added_count} треков."
+        )
+    except Exception as e:
+        print(f"Playlist ingestion failed for {url}: {e}")
+        await message.edit(content=f"⚠️ Плейлист загружен не полностью ({added_count} треков): {e}")
+    finally:
+        playlist_imports.get(guild_id, set()).discard(asyncio.current_task())
+
+def cancel_playlist_import(guild_id):
+    for task in playlist_imports.pop(guild_id, set()):
+        task.cancel()
+
+# --- Search Autocomplete ---
+# /play suggests YouTube results while the user types. Results are cached by
+# normalized query for all guilds; while a new query is being searched, the
+# longest cached prefix of it is filtered and shown instead. Every keystroke
+# is its own autocomplete request, so only the last one of a user's burst
+# searches, and identical queries in flight share one extraction.
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", 8))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 30 * 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1000))
+SEARCH_MIN_LENGTH = 3
+SEARCH_DEBOUNCE = 0.35
+# Discord drops autocomplete responses after 3 s; a slower search still
+# finishes in the background and fills the cache for the next keystroke
+SEARCH_WAIT = 2.0
+# Discord's limit for choice names and values
+CHOICE_MAX_LENGTH = 100
+
+SEARCH_REQUESTS = metrics.register(Counter(
+    "voicebot_search_requests_total", "/play autocomplete lookups", ("result",)))
+
+def normalize_query(query):
+    return " ".join(query.split()).casefold()
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+class SearchCache:
+    # LRU of query -> results with a TTL, plus the metadata of every result
+    # still cached, so picking a suggestion needs no extraction in play()
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # normalized query -> (fetched_at, results)
+        self.tracks = OrderedDict()   # web_url -> result
+        self.max_tracks = max_entries * SEARCH_RESULTS
+
+    def get(self, query):
+        entry = self.entries.get(query)
+        if entry is None:
+            return None
+        fetched_at, results = entry
+        if time.monotonic() - fetched_at > self.ttl:
+            del self.entries[query]
+            return None
+        self.entries.move_to_end(query)
+        return results
+
+    def closest(self, query):
+        # Results of the longest cached prefix that still match every typed word
+        words = query.split()
+        for end in range(len(query) - 1, SEARCH_MIN_LENGTH - 1, -1):
+            results = self.get(query[:end])
+            if results is not None:
+                return [r for r in results if all(word in r['title'].casefold() for word in words)]
+        return None
+
+    def put(self, query, results):
+        self.entries[query] = (time.monotonic(), results)
+        self.entries.move_to_end(query)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        for result in results:
+            self.tracks[result['url']] = result
+            self.tracks.move_to_end(result['url'])
+        while len(self.tracks) > self.max_tracks:
+            self.tracks.popitem(last=False)
+
+    def track(self, web_url):
+        # Returns a single-track listing, in the shape play() expects
+        result = self.tracks.get(web_url)
+        if result is None:
+            return None
+        return {'title': result['title'], 'webpage_url': web_url}
+
+    def clear(self):
+        self.entries.clear()
+        self.tracks.clear()
+
+    def stats(self):
+        return {'queries': len(self.entries), 'tracks': len(self.tracks), 'in_flight': len(pending_searches)}
+
+search_cache = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+# normalized query -> asyncio.Task running that search
+pending_searches = {}
+
+# user_id -> the last query the user typed, for debouncing
+latest_queries = {}
+
+async def _search(guild_id, query):
+    # Other guilds' autocompletes may be waiting on this search too
+    data = await extraction.extract(guild_id, f"ytsearch{SEARCH_RESULTS}:{query}", flat=True, cancellable=False)
+    # Some flat entries come back with a null title; show the URL instead, so
+    # matching and choice names never see None
+    results = [
+        {**entry, 'title': entry.get('title') or entry['url']}
+        for entry in data.get('entries', [])
+        if entry['url'] and len(entry['url']) <= CHOICE_MAX_LENGTH
+    ]
+    search_cache.put(query, results)
+    return results
+
+def _search_done(query, task):
+    pending_searches.pop(query, None)
+    # Nobody may be waiting any more; retrieve the error so it isn't reported as lost
+    if not task.cancelled() and task.exception():
+        print(f"Search failed for {query!r}: {task.exception()}")
+
+async def search_tracks(guild_id, query):
+    task = pending_searches.get(query)
+    if task is None:
+        SEARCH_REQUESTS.inc("miss")
+        task = asyncio.ensure_future(_search(guild_id, query))
+        pending_searches[query] = task
+        task.add_done_callback(lambda t: _search_done(query, t))
+    else:
+        SEARCH_REQUESTS.inc("coalesced")
+    # shield: a timed-out autocomplete must not cancel the shared search
+    return await asyncio.shield(task)
+
+def search_choices(results):
+    choices = []
+    for result in results[:25]:
+        name = result['title']
+        if result.get('duration'):
+            name = f"{name} ({format_duration(result['duration'])})"
+        if len(name) > CHOICE_MAX_LENGTH:
+            name = name[:CHOICE_MAX_LENGTH - 1] + "…"
+        choices.append(app_commands.Choice(name=name, value=result['url']))
+    return choices
+
+# --- Music Source Selection ---
+# Paths a music stream can take, cheapest first:
+#   cache          - hot track played from the local Opus packet cache
+#   opus_copy      - source is already Opus, ffmpeg only remuxes it into Ogg
+#   opus_transcode - ffmpeg decodes and encodes to Opus itself, off our GIL
+#   pcm            - ffmpeg decodes to PCM and discord.py encodes every frame in Python
+PLAYBACK_PATHS = ('cache', 'opus_copy', 'opus_transcode', 'pcm')
+
+# guild_id -> {'last': str, 'cache': int, 'opus_copy': int, 'opus_transcode': int, 'pcm': int}
+playback_path_stats = {}
+
+def record_playback_path(guild_id, path, acodec):
+    stats = playback_path_stats.setdefault(guild_id, dict.fromkeys(PLAYBACK_PATHS, 0))
+    stats[path] += 1
+    stats['last'] = path
+    print(f"Playback path: {path} (acodec={acodec})")
+
+def create_music_source(guild_id, stream_url, acodec, start=0.0, gain=0.0):
+    options = dict(FFMPEG_OPTIONS)
+    if start:
+        # Input seek: ffmpeg asks the server for a byte range instead of decoding up to it
+        options['before_options'] = f"{options['before_options']} -ss {start:.2f}"
+    if gain:
+        # ffmpeg decodes the stream anyway, so the filter is nearly free; only an
+        # Opus stream that would otherwise be copied pays for a transcode
+        options['options'] = f"{options['options']} -af volume={gain:.1f}dB"
+    if acodec == 'opus' and not gain:
+        path = 'opus_copy'
+        source = discord.FFmpegOpusAudio(stream_url, codec='copy', **options)
+    elif shutil.which("ffmpeg") and not os.getenv("DISABLE_OPUS_TRANSCODE"):
+        path = 'opus_transcode'
+        source = discord.FFmpegOpusAudio(stream_url, **options)
+    else:
+        path = 'pcm'
+        source = discord.FFmpegPCMAudio(stream_url, **options)
+
+    record_playback_path(guild_id, path, acodec)
+    return source
+
+# --- Hot Track Cache ---
+# Opt-in (set TRACK_CACHE_DIR). Tracks played TRACK_CACHE_MIN_PLAYS times are
+# transcoded once in the background into a file of raw Opus packets:
+#   magic | uint32 packet count N | N+1 uint32 offsets | packets
+# Playback maps the file and hands out packets straight from the mapping, so
+# a hot track needs no yt-dlp call, no network and no ffmpeg at all.
+TRACK_CACHE_DIR = os.getenv("TRACK_CACHE_DIR")
+TRACK_CACHE_MAX_BYTES = int(os.getenv("TRACK_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+TRACK_CACHE_MIN_PLAYS = int(os.getenv("TRACK_CACHE_MIN_PLAYS", 3))
+TRACK_CACHE_MAGIC = b"VBOPUS1\0"
+# ~1 hour at 128 kbit/s; longer streams (mixes, radio) aren't worth a slot
+TRACK_CACHE_MAX_TRACK_BYTES = 64 * 1024 * 1024
+TRACK_CACHE_FILL_TIMEOUT = 15 * 60
+
+TRACK_CACHE_REQUESTS = metrics.register(Counter(
+    "voicebot_track_cache_requests_total", "Hot track cache lookups", ("result",)))
+
+class CachedOpusSource(discord.AudioSource):
+    def __init__(self, path):
+        self.mm = None
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.mm[:len(TRACK_CACHE_MAGIC)] != TRACK_CACHE_MAGIC:
+                raise ValueError(f"{path} is not a track cache file")
+            count = struct.unpack_from('<I', self.mm, len(TRACK_CACHE_MAGIC))[0]
+            index_start = len(TRACK_CACHE_MAGIC) + 4
+            self.base = index_start + 4 * (count + 1)
+            # A view into the mapping, not a copy
+            self.offsets = memoryview(self.mm)[index_start:self.base].cast('I')
+        except Exception:
+            self.mm.close()
+            raise
+        self.count = count
+        self.position = 0
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if self.position >= self.count:
+            return b''
+        start = self.base + self.offsets[self.position]
+        end = self.base + self.offsets[self.position + 1]
+        self.position += 1
+        # Slicing the mapping makes one small bytes object per packet; the voice
+        # client and opus decoder need real bytes, so a memoryview can't go further
+        return self.mm[start:end]
+
+    def cleanup(self):
+        if self.mm is None or self.mm.closed:
+            return
+        # The index view must be released before the mapping can close
+        self.offsets.release()
+        self.mm.close()
+
+def read_opus_packets(stream_url, acodec):
+    # Same encoding FFmpegOpusAudio uses for live playback
+    codec = 'copy' if acodec == 'opus' else 'libopus'
+    args = ['ffmpeg', *shlex.split(FFMPEG_OPTIONS['before_options']), '-i', stream_url, '-vn',
+            '-map_metadata', '-1', '-f', 'opus', '-c:a', codec, '-ar', '48000', '-ac', '2', '-b:a', '128k',
+            '-loglevel', 'warning', 'pipe:1']
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    timer = threading.Timer(TRACK_CACHE_FILL_TIMEOUT, process.kill)
+    timer.start()
+    packets = []
+    size = 0
+    try:
+        for packet in discord.oggparse.OggStream(process.stdout).iter_packets():
+            # Ogg Opus header packets aren't audio
+            if packet.startswith((b'OpusHead', b'OpusTags')):
+                continue
+            packets.append(packet)
+            size += len(packet)
+            if size > TRACK_CACHE_MAX_TRACK_BYTES:
+                raise ValueError("track too long to cache")
+        # Killed by the timer means a truncated track
+        returncode = process.wait()
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    if returncode != 0 or not packets:
+        raise ValueError(f"ffmpeg exited with {returncode}")
+    return packets
+
+class TrackCache:
+    # Play counts and cached files are tracked in a small SQLite index next to
+    # the files. Eviction keeps the disk budget: least played first, least
+    # recently played among equals (LFU with an LRU tie-break).
+    def __init__(self, directory, max_bytes, min_plays):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "web_url TEXT PRIMARY KEY, plays INTEGER NOT NULL, last_played REAL NOT NULL, bytes INTEGER)"
+        )
+        self.conn.commit()
+        # One fill at a time: it is background work and shouldn't compete with playback
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="track-cache")
+        self.filling = set()
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.fill_failures = 0
+        self.evictions = 0
+
+    def path(self, web_url):
+        return os.path.join(self.directory, hashlib.sha256(web_url.encode('utf-8')).hexdigest() + ".opus")
+
+    def open(self, web_url):
+        # Files are named after the URL, so other cluster workers' fills are found too
+        try:
+            source = CachedOpusSource(self.path(web_url))
+        except FileNotFoundError:
+            source = None
+        except (OSError, ValueError) as e:
+            print(f"Track cache read failed: {e}")
+            source = None
+        if source is None:
+            self.misses += 1
+            TRACK_CACHE_REQUESTS.inc("miss")
+        else:
+            self.hits += 1
+            TRACK_CACHE_REQUESTS.inc("hit")
+        return source
+
+    def record_play(self, web_url):
+        # Returns (plays so far, whether the track is cached)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO tracks (web_url, plays, last_played) VALUES (?, 1, ?) "
+                "ON CONFLICT(web_url) DO UPDATE SET plays = plays + 1, last_played = excluded.last_played",
+                (web_url, time.time())
+            )
+            plays, size = self.conn.execute(
+                "SELECT plays, bytes FROM tracks WHERE web_url = ?", (web_url,)
+            ).fetchone()
+        return plays, size is not None
+
+    def played(self, web_url, stream_url=None, acodec=None):
+        # Runs on the cache thread: count the play and start a fill once the track is hot
+        plays, cached = self.record_play(web_url)
+        if cached or plays < self.min_plays or stream_url is None or web_url in self.filling:
+            return
+        if not self._worth_caching(plays):
+            return
+        self.filling.add(web_url)
+        try:
+            self._fill(web_url, stream_url, acodec)
+        finally:
+            self.filling.discard(web_url)
+
+    def submit_play(self, web_url, stream_url=None, acodec=None):
+        future = self.executor.submit(self.played, web_url, stream_url, acodec)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if future.exception():
+            print(f"Track cache error: {future.exception()}")
+
+    def _worth_caching(self, plays):
+        # With the disk full, only a track hotter than the coldest cached one gets in;
+        # otherwise it would be the next victim and get downloaded over and over
+        with self.lock:
+            total, coldest = self.conn.execute(
+                "SELECT COALESCE(SUM(bytes), 0), MIN(plays) FROM tracks WHERE bytes IS NOT NULL"
+            ).fetchone()
+        return total < self.max_bytes or coldest is None or plays > coldest
+
+    def _fill(self, web_url, stream_url, acodec):
+        started = time.monotonic()
+        try:
+            packets = read_opus_packets(stream_url, acodec)
+        except Exception as e:
+            self.fill_failures += 1
+            print(f"Track cache fill failed for {web_url}: {e}")
+            return
+
+        offsets = array.array('I', [0])
+        for packet in packets:
+            offsets.append(offsets[-1] + len(packet))
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+
+        path = self.path(web_url)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(TRACK_CACHE_MAGIC)
+            f.write(struct.pack('<I', len(packets)))
+            f.write(offsets.tobytes())
+            f.writelines(packets)
+        size = os.path.getsize(tmp_path)
+        # Atomic: a reader sees the old file, no file, or the complete new one
+        os.replace(tmp_path, path)
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tracks SET bytes = ? WHERE web_url = ?", (size, web_url))
+        self.fills += 1
+        print(f"Track cached: {web_url} ({size / 1024 / 1024:.1f} MB in {time.monotonic() - started:.1f} s)")
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM tracks").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            victims = self.conn.execute(
+                "SELECT web_url, bytes FROM tracks WHERE bytes IS NOT NULL ORDER BY plays, last_played"
+            ).fetchall()
+            for web_url, size in victims:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self.path(web_url))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Still mapped by a player on Windows; try again next time
+                    print(f"Track cache eviction skipped {web_url}: {e}")
+                    continue
+                self.conn.execute("UPDATE tracks SET bytes = NULL WHERE web_url = ?", (web_url,))
+                total -= size
+                self.evictions += 1
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(bytes), COALESCE(SUM(bytes), 0) FROM tracks"
+            ).fetchone()
+        return {
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'fills': self.fills,
+            'fill_failures': self.fill_failures,
+            'evictions': self.evictions,
+            'filling': len(self.filling),
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+track_cache = TrackCache(TRACK_CACHE_DIR, TRACK_CACHE_MAX_BYTES, TRACK_CACHE_MIN_PLAYS) if TRACK_CACHE_DIR else None
+
+# --- Loudness Normalization ---
+# Each track's integrated loudness is measured once, by a background ffmpeg
+# pass through loudnorm in analysis mode, and kept in an index by web_url.
+# Later plays apply one fixed gain towards the guild's target: a volume
+# filter in the ffmpeg that plays the stream, or numpy scaling in the mixer
+# for tracks played from the hot track cache.
+LOUDNESS_OFF = 0
+LOUDNESS_TARGETS = [
+    app_commands.Choice(name="Громко (−14 LUFS, как YouTube и Spotify)", value=-14),
+    app_commands.Choice(name="Средне (−16 LUFS)", value=-16),
+    app_commands.Choice(name="Тихо (−20 LUFS)", value=-20),
+    app_commands.Choice(name="Эфирный стандарт (−23 LUFS)", value=-23),
+    app_commands.Choice(name="Выключить", value=LOUDNESS_OFF),
+]
+# Quiet tracks are boosted at most this much, and never past the peak ceiling (dBTP)
+LOUDNESS_MAX_BOOST = 10.0
+LOUDNESS_PEAK_CEILING = -1.0
+# Smaller corrections aren't audible enough to be worth a transcode
+LOUDNESS_MIN_GAIN = 1.0
+# Long mixes are judged by their first half hour
+LOUDNESS_MAX_SECONDS = 30 * 60
+LOUDNESS_TIMEOUT = 10 * 60
+
+def measure_loudness(stream_url):
+    # Returns (integrated loudness in LUFS, true peak in dBTP); None for silence
+    args = ['ffmpeg', '-hide_banner', '-nostats', *shlex.split(FFMPEG_OPTIONS['before_options']),
+            '-t', str(LOUDNESS_MAX_SECONDS), '-i', stream_url, '-vn',
+            '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+    result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            timeout=LOUDNESS_TIMEOUT)
+    if result.returncode != 0:
+        raise ValueError(f"ffmpeg exited with {result.returncode}")
+    # loudnorm prints its measurements as the last JSON object on stderr
+    text = result.stderr.decode('utf-8', 'replace')
+    stats = json.loads(text[text.rindex('{'):text.rindex('}') + 1])
+    lufs = float(stats['input_i'])
+    peak = float(stats['input_tp'])
+    if not math.isfinite(lufs):
+        return None, None
+    return lufs, peak if math.isfinite(peak) else None
+
+class LoudnessIndex:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS loudness ("
+            "web_url TEXT PRIMARY KEY, lufs REAL, peak REAL, measured_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+        # One measurement at a time: background work, like cache fills
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")
+        self.pending = set()
+        self.measured = 0
+        self.failures = 0
+
+    def get(self, web_url):
+        # Returns (lufs, peak), or None if the track hasn't been measured yet
+        with self.lock:
+            return self.conn.execute("SELECT lufs, peak FROM loudness WHERE web_url = ?", (web_url,)).fetchone()
+
+    def submit(self, web_url, stream_url):
+        if web_url in self.pending:
+            return
+        self.pending.add(web_url)
+        future = self.executor.submit(self._measure, web_url, stream_url)
+        future.add_done_callback(lambda f: self.pending.discard(web_url))
+
+    def _measure(self, web_url, stream_url):
+        if self.get(web_url) is not None:
+            return
+        started = time.monotonic()
+        try:
+            lufs, peak = measure_loudness(stream_url)
+        except Exception as e:
+            self.failures += 1
+            print(f"Loudness measurement failed for {web_url}: {e}")
+            return
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO loudness (web_url, lufs, peak, measured_at) VALUES (?, ?, ?, ?)",
+                (web_url, lufs, peak, time.time())
+            )
+        self.measured += 1
+        print(f"Loudness of {web_url}: {lufs} LUFS, peak {peak} dBTP ({time.monotonic() - started:.1f} s)")
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM loudness").fetchone()[0]
+        return {'entries': entries, 'measured': self.measured, 'failures': self.failures, 'pending': len(self.pending)}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+loudness_index = LoudnessIndex(LOUDNESS_FILE)
+
+def analyze_loudness(guild_id, web_url, stream_url):
+    # Only tracks that a guild with normalization on plays are worth a download
+    if guild_loudness.get(guild_id, LOUDNESS_TARGET) != LOUDNESS_OFF:
+        loudness_index.submit(web_url, stream_url)
+
+def loudness_gain(guild_id, measured):
+    # dB to apply to a track in this guild; 0 when off, unmeasured or already close
+    target = guild_loudness.get(guild_id, LOUDNESS_TARGET)
+    if target == LOUDNESS_OFF or measured is None or measured[0] is None:
+        return 0.0
+    lufs, peak = measured
+    gain = target - lufs
+    if gain > 0:
+        gain = min(gain, LOUDNESS_MAX_BOOST)
+        if peak is not None:
+            gain = max(0.0, min(gain, LOUDNESS_PEAK_CEILING - peak))
+    return gain if abs(gain) >= LOUDNESS_MIN_GAIN else 0.0
+
+# --- Music Queue Logic ---
+# A track that stops more than this many seconds before its known end was cut
+# off (expired URL, reset connection) rather than finished, and is resumed
+RESUME_TAIL_SECONDS = 5
+RESUME_MAX_ATTEMPTS = 3
+FRAME_SECONDS = 0.02
+
+async def play_next(interaction: discord.Interaction):
+    # Entries that fail to start are skipped in this loop, not by recursing,
+    # so a run of dead entries can't pile up stack frames
+    guild_id = interaction.guild_id
+    queue = get_queue(guild_id)
+    while True:
+        track = queue.next()
+        if track is None:
+            # Queue empty
+            track_ended_at.pop(guild_id, None)
+            return
+        if await start_track(interaction, track):
+            return
+
+async def resume_track(interaction: discord.Interaction, track, position, attempt):
+    if get_queue(interaction.guild_id).current is not track:
+        # /stop, /skip or /leave in the meantime
+        return
+    if not await start_track(interaction, track, position, attempt):
+        await play_next(interaction)
+
+class PlaybackAborted(Exception):
+    # The track was stopped, skipped or disconnected before it could start
+    pass
+
+async def start_track(interaction: discord.Interaction, track, start_at=0.0, attempt=0):
+    # Returns False if the track couldn't be started and the caller should move on
+    guild_id = interaction.guild_id
+    web_url = track.web_url
+    title = track.title
+
+    voice_client = interaction.guild.voice_client
+    if not voice_client:
+        return True
+
+    requested_at = time.monotonic()
+    holding_stream = False
+    # Hot tracks play from the local cache: no extraction, network or ffmpeg
+    cached_source = track_cache.open(web_url) if track_cache and not start_at else None
+    stream_url = acodec = duration = None
+    music = None
+    started = False
+
+    try:
+        measured = await asyncio.get_event_loop().run_in_executor(None, loudness_index.get, web_url)
+        gain = loudness_gain(guild_id, measured)
+        level = 1.0
+        if cached_source is None:
+            print(f"Resolving stream for: {title}")
+            # Usually already resolved by the prefetcher while the previous track played;
+            # a resume needs a new URL since the old one is what just failed
+            with trace_span("stream.resolve"):
+                stream_url, _, acodec, duration = await resolve_stream(guild_id, web_url, fresh=attempt > 0)
+
+            # One slot per ffmpeg-backed stream; held until the track ends
+            waiting_for_stream.add(guild_id)
+            try:
+                with trace_span("stream.admission"):
+                    await stream_budget.acquire(guild_id, PRIORITY_PLAYBACK)
+            finally:
+                waiting_for_stream.discard(guild_id)
+            holding_stream = True
+            if get_queue(guild_id).current is not track or not voice_client.is_connected():
+                # /stop or /leave while we waited for the slot
+                raise PlaybackAborted()
+            music = create_music_source(guild_id, stream_url, acodec, start_at, gain)
+        else:
+            record_playback_path(guild_id, 'cache', 'opus')
+            music = cached_source
+            duration = cached_source.count * FRAME_SECONDS
+            if gain and discord.opus.is_loaded():
+                # Costs a decode and encode per frame, as when speech is mixed in
+                level = 10 ** (gain / 20)
+        uses_stream_slot = holding_stream
+
+        # Wrapped in a mixer so /say can speak over the track without stopping it
+        source = MixingAudioSource(music, level)
+        source.requested_at = requested_at
 
-FFMPEG_OPTIONS = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-    'options': '-vn',
-}
+        # Define callback to play next after this one finishes
+        def after_playing(error):
+            if error:
+                print(f"Error in playback: {error}")
+                ERRORS_TOTAL.inc("playback")
+            if uses_stream_slot:
+                bot.loop.call_soon_threadsafe(stream_budget.release, guild_id)
+            # music_done tells a stream that ran out apart from /skip or /stop
+            position = start_at + source.frames * FRAME_SECONDS
+            cut_off = (error or source.music_done) and duration and position < duration - RESUME_TAIL_SECONDS
+            if cut_off and attempt < RESUME_MAX_ATTEMPTS:
+                print(f"Stream dropped at {position:.0f}/{duration:.0f} s, resuming: {title}")
+                ERRORS_TOTAL.inc("stream_dropped")
+                coro = resume_track(interaction, track, position, attempt + 1)
+            else:
+                track_ended_at[guild_id] = time.monotonic()
+                # Schedule next song
+                coro = play_next(interaction)
+            fut = asyncio.run_coroutine_threadsafe(coro, bot.loop)
+            try:
+                fut.result()
+            except:
+                pass
 
-ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+        # A /say between two tracks plays on its own; let it finish rather than fail the track
+        while voice_client.is_playing():
+            await asyncio.sleep(0.1)
+        if get_queue(guild_id).current is not track or not voice_client.is_connected():
+            raise PlaybackAborted()
 
-class TTSAudioSource(discord.AudioSource):
-    def __init__(self, mp3_bytes):
-        self.mp3_bytes = mp3_bytes
-        self.ffmpeg_process = None
-        self.pcm_output = None
+        voice_client.play(source, after=after_playing)
+        # From here on after_playing releases the slot and the player cleans up
+        started = True
+        record_gap(guild_id)
+        if start_at:
+            print(f"Resumed at {start_at:.0f} s: {title}")
+        else:
+            print(f"Now playing: {title}" + (f" ({gain:+.1f} dB)" if gain else ""))
+            if measured is None and stream_url:
+                analyze_loudness(guild_id, web_url, stream_url)
+            if track_cache:
+                # Counts the play; once the track is hot, caches it from this stream URL
+                track_cache.submit_play(web_url, stream_url, acodec)
 
-    def read(self):
-        if self.pcm_output is None:
-            args = [
-                'ffmpeg',
-                '-i', 'pipe:0',
-                '-f', 's16le',
-                '-ar', '48000',
-                '-ac', '2',
-                '-loglevel', 'quiet',
-                'pipe:1'
-            ]
-            
-            import subprocess
-            self.ffmpeg_process = subprocess.Popen(
-                args,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            
-            out, err = self.ffmpeg_process.communicate(input=self.mp3_bytes.getvalue())
-            self.pcm_output = io.BytesIO(out)
-        
-        ret = self.pcm_output.read(3840)
-        if len(ret) == 0:
-            return b''
-        return ret
+        # The stream URL is single-use for this play; resolve the upcoming ones
+        resolved_streams.pop(web_url, None)
+        schedule_prefetch(guild_id)
+        return True
 
-    def cleanup(self):
-        if self.ffmpeg_process:
-            self.ffmpeg_process.kill()
+    except PlaybackAborted:
+        return True
+    except discord.ClientException as e:
+        # Voice connection trouble, not the track's fault: don't skip through the queue
+        print(f"Could not start {title}: {e}")
+        return True
+    except Exception as e:
+        print(f"Error playing {title}: {e}")
+        ERRORS_TOTAL.inc("play_next")
+        return False
+    finally:
+        if not started:
+            if holding_stream:
+                stream_budget.release(guild_id)
+            # Kills the ffmpeg process, or unmaps the cached file
+            unused = music if music is not None else cached_source
+            if unused is not None:
+                unused.cleanup()
 
-# --- Music Queue Logic ---
-async def play_next(interaction: discord.Interaction):
-    guild_id = interaction.guild_id
-    if guild_id in music_queues and music_queues[guild_id]:
-        # Get next song info
-        next_song = music_queues[guild_id].pop(0)
-        web_url = next_song['web_url']
-        title = next_song['title']
-        
-        voice_client = interaction.guild.voice_client
-        if not voice_client:
-            return
+def command_tree_hash():
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
 
-        print(f"Resolving stream for: {title}")
-        
-        try:
-            # Resolve stream URL just-in-time
-            loop = asyncio.get_event_loop()
-            data = await loop.run_in_executor(None, lambda: ytdl.extract_info(web_url, download=False))
-            
-            if 'entries' in data:
-                data = data['entries'][0]
-                
-            stream_url = data['url']
-            
-            source = discord.FFmpegPCMAudio(stream_url, **FFMPEG_OPTIONS)
-            
-            # Define callback to play next after this one finishes
-            def after_playing(error):
-                if error:
-                    print(f"Error in playback: {error}")
-                # Schedule next song
-                coro = play_next(interaction)
-                fut = asyncio.run_coroutine_threadsafe(coro, bot.loop)
-                try:
-                    fut.result()
-                except:
-                    pass
+async def sync_command_tree(force=False):
+    # Returns the synced commands, or None if the tree is unchanged since the last sync
+    key = f"command_tree_hash:{bot.application_id}"
+    digest = command_tree_hash()
+    loop = asyncio.get_event_loop()
+    if not force and await loop.run_in_executor(None, state_store.get_meta, key) == digest:
+        return None
+    synced = await bot.tree.sync()
+    await loop.run_in_executor(None, state_store.set_meta, key, digest)
+    return synced
 
-            voice_client.play(source, after=after_playing)
-            print(f"Now playing: {title}")
-            
-        except Exception as e:
-            print(f"Error playing {title}: {e}")
-            # Skip to next if failed
-            await play_next(interaction)
-    else:
-        # Queue empty
-        pass
+# on_ready fires again after every reconnect; startup work happens once
+startup_done = False
+
+@bot.event
+async def setup_hook():
+    mark_startup("login")
 
 @bot.event
 async def on_ready():
+    global startup_done
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
-    try:
-        synced = await bot.tree.sync()
-        print(f'Synced {len(synced)} commands globally')
-    except Exception as e:
-        print(f'Failed to sync commands: {e}')
+    if startup_done:
+        return
+    startup_done = True
+    mark_startup("gateway")
+
+    # Commands are global; in cluster mode one worker syncing them is enough
+    if CLUSTER_ID in (None, "0"):
+        try:
+            synced = await sync_command_tree()
+            if synced is None:
+                print('Command tree unchanged, skipping sync')
+            else:
+                print(f'Synced {len(synced)} commands globally')
+        except Exception as e:
+            print(f'Failed to sync commands: {e}')
+        mark_startup("command sync")
+
+    print(startup_report())
+    extraction.warm_up()
     print('------')
 
+@bot.event
+async def on_app_command_completion(interaction, command):
+    trace = interaction.extras.get('trace')
+    if trace:
+        trace.finish("ok")
+
 @bot.tree.command(name="setvoice", description="Выбрать голос озвучки (20+ вариантов)")
 @app_commands.describe(voice="Выберите голос из списка")
 @app_commands.choices(voice=VOICES)
@@ -245,8 +3127,40 @@ async def setvoice(interaction: discord.Interaction, voice: app_commands.Choice[
     if not await check_permissions(interaction): return
 
     guild_settings[interaction.guild_id] = voice.value
+    state_store.mark_settings(interaction.guild_id)
     await interaction.response.send_message(f"✅ Голос изменен на: **{voice.name}**", ephemeral=True)
 
+@bot.tree.command(name="setengine", description="Выбрать движок озвучки")
+@app_commands.describe(engine="Движок синтеза речи")
+@app_commands.choices(engine=[
+    app_commands.Choice(name=engine.label, value=engine.name) for engine in TTS_ENGINES.values()
+])
+async def setengine(interaction: discord.Interaction, engine: app_commands.Choice[str]):
+    if not await check_permissions(interaction): return
+
+    if not TTS_ENGINES[engine.value].available():
+        await interaction.response.send_message(f"❌ Движок **{engine.name}** не установлен на сервере.", ephemeral=True)
+        return
+
+    guild_engines[interaction.guild_id] = engine.value
+    state_store.mark_settings(interaction.guild_id)
+    await interaction.response.send_message(f"✅ Движок озвучки: **{engine.name}**", ephemeral=True)
+
+@bot.tree.command(name="loudness", description="Выровнять громкость треков")
+@app_commands.describe(level="Целевая громкость музыки")
+@app_commands.choices(level=LOUDNESS_TARGETS)
+async def loudness(interaction: discord.Interaction, level: app_commands.Choice[int]):
+    if not await check_permissions(interaction): return
+
+    guild_loudness[interaction.guild_id] = level.value
+    state_store.mark_settings(interaction.guild_id)
+    if level.value == LOUDNESS_OFF:
+        await interaction.response.send_message("✅ Выравнивание громкости выключено.", ephemeral=True)
+    else:
+        await interaction.response.send_message(
+            f"✅ Громкость: **{level.name}**. Применится со следующего трека.", ephemeral=True
+        )
+
 @bot.tree.command(name="say", description="Озвучить текст в голосовом канале")
 @app_commands.describe(text="Текст для озвучки")
 async def say(interaction: discord.Interaction, text: str):
@@ -257,74 +3171,117 @@ async def say(interaction: discord.Interaction, text: str):
         return
 
     await interaction.response.defer(ephemeral=True)
+    requested_at = time.monotonic()
+
+    if not voice_connection_available(interaction.guild):
+        await interaction.followup.send("⏳ Бот сейчас занят на других серверах, попробуйте чуть позже.", ephemeral=True)
+        return
 
     channel = interaction.user.voice.channel
     voice_client = interaction.guild.voice_client
 
-    if voice_client:
-        if voice_client.channel != channel:
-            await voice_client.move_to(channel)
-    else:
-        voice_client = await channel.connect()
+    with trace_span("voice.connect"):
+        if voice_client:
+            if voice_client.channel != channel:
+                await voice_client.move_to(channel)
+        else:
+            voice_client = await channel.connect()
 
+    source = None
+    # Once the player or the mixer has the source, they clean it up
+    handed_over = False
     try:
-        # Debug: Check ffmpeg
-        import shutil
-        import traceback
-        if not shutil.which("ffmpeg"):
-            print("❌ CRITICAL: ffmpeg not found in PATH!")
-            await interaction.followup.send("Ошибка: ffmpeg не найден в системе.", ephemeral=True)
-            return
-
         # Get selected voice or default
         voice = guild_settings.get(interaction.guild_id, "ru-RU-DmitryNeural")
-        
-        print(f"🎤 Generating TTS with gTTS, text: '{text[:50]}...'")
-        
-        # Generate TTS with gTTS (Google Text-to-Speech)
-        try:
-            # gTTS uses language codes, not voice names
-            lang = 'ru'  # Default to Russian
-            
-            # Create TTS in executor (gTTS is blocking)
-            loop = asyncio.get_event_loop()
-            
-            def generate_tts():
-                tts = gTTS(text=text, lang=lang, slow=False)
-                fp = io.BytesIO()
-                tts.write_to_fp(fp)
-                fp.seek(0)
-                return fp
-            
-            mp3_fp = await loop.run_in_executor(None, generate_tts)
-            
-            print(f"✅ Generated audio, size: {mp3_fp.tell()} bytes")
-            
-            if mp3_fp.tell() == 0:
-                raise Exception("No audio data generated")
-                
-            mp3_fp.seek(0)
-            
-        except Exception as tts_error:
-            print(f"❌ TTS Error: {tts_error}")
-            traceback.print_exc()
-            await interaction.followup.send(f"Ошибка генерации речи: {tts_error}", ephemeral=True)
+        engine = get_engine(interaction.guild_id)
+
+        cache_key = TTSCache.make_key(text, engine.name, engine.cache_voice(voice))
+        # A memory miss falls through to a disk read, so keep it off the event loop
+        loop = asyncio.get_event_loop()
+        cached_frames = await loop.run_in_executor(None, tts_cache.get, cache_key)
+
+        if cached_frames is not None:
+            print(f"🎤 TTS cache hit, text: '{text[:50]}...'")
+            source = CachedPCMAudioSource(cached_frames)
+        else:
+            # Waits for the startup ffmpeg lookup if it's still running
+            if not await loop.run_in_executor(None, ensure_ffmpeg):
+                print("❌ CRITICAL: ffmpeg not found in PATH!")
+                await interaction.followup.send("Ошибка: ffmpeg не найден в системе.", ephemeral=True)
+                return
+
+            print(f"🎤 Generating TTS with {engine.name}, text: '{text[:50]}...'")
+
+            # Chunks are synthesized in parallel; playback starts as soon as the first has audio
+            try:
+                with trace_span("tts.synthesize"):
+                    engine, chunks = await synthesize_speech(interaction.guild_id, text, voice)
+                print(f"✅ First audio ready from {engine.name} ({len(chunks)} chunks)")
+
+            except Exception as tts_error:
+                ERRORS_TOTAL.inc("tts")
+                print(f"❌ TTS Error: {tts_error}")
+                traceback.print_exc()
+                await interaction.followup.send(f"Ошибка генерации речи: {tts_error}", ephemeral=True)
+                return
+
+            # The engine may have changed on fallback; cache under the one that produced the audio
+            cache_key = TTSCache.make_key(text, engine.name, engine.cache_voice(voice))
+            try:
+                with trace_span("decoder.acquire"):
+                    process = await decoder_pool.acquire_async(interaction.guild_id, engine.ffmpeg_input_args)
+            except TimeoutError:
+                for chunk in chunks:
+                    chunk.cancel()
+                await interaction.followup.send("⏳ Все декодеры заняты, попробуйте чуть позже.", ephemeral=True)
+                return
+            except OSError as e:
+                # ffmpeg couldn't be started (process or memory limit)
+                for chunk in chunks:
+                    chunk.cancel()
+                ERRORS_TOTAL.inc("tts")
+                print(f"❌ Decoder spawn failed: {e}")
+                await interaction.followup.send("Ошибка: не удалось запустить декодер, попробуйте чуть позже.", ephemeral=True)
+                return
+
+            source = ChunkedTTSAudioSource(
+                chunks,
+                on_complete=lambda frames: tts_cache.put(cache_key, frames),
+                process=process,
+                pool=decoder_pool,
+                max_frames=tts_cache.max_entry_bytes // FRAME_SIZE
+            )
+
+        source.requested_at = requested_at
+
+        # A new message replaces the one still being spoken
+        cancel_speech(interaction.guild_id)
+        active_speech[interaction.guild_id] = source
+
+        mixer = voice_client.source if voice_client.is_playing() else None
+        if isinstance(mixer, MixingAudioSource) and mixer.can_mix():
+            # Music is playing: duck it and speak over it instead of skipping the track
+            mixer.add_overlay(source)
+            handed_over = True
+            await interaction.followup.send("✅ Озвучено", ephemeral=True)
             return
-        
-        source = TTSAudioSource(mp3_fp)
-        
+
         if voice_client.is_playing():
             voice_client.stop()
             
         voice_client.play(source, after=lambda e: print(f'Player error: {e}') if e else None)
+        handed_over = True
         await interaction.followup.send("✅ Озвучено", ephemeral=True)
         
     except Exception as e:
+        if source is not None and not handed_over:
+            # Kills the decoder and gives its slot back to the pool
+            source.cleanup()
         traceback.print_exc()
         await interaction.followup.send(f"Ошибка ({type(e).__name__}): {e}", ephemeral=True)
 
 @bot.tree.command(name="play", description="Включить музыку (YouTube, SoundCloud, Spotify плейлисты)")
-@app_commands.describe(url="Ссылка на трек или плейлист")
+@app_commands.describe(url="Ссылка на трек или плейлист, или название для поиска")
 async def play(interaction: discord.Interaction, url: str):
     if not await check_permissions(interaction): return
 
@@ -334,14 +3291,19 @@ async def play(interaction: discord.Interaction, url: str):
 
     await interaction.response.defer(ephemeral=True)
 
+    if not voice_connection_available(interaction.guild):
+        await interaction.followup.send("⏳ Бот сейчас занят на других серверах, попробуйте чуть позже.", ephemeral=True)
+        return
+
     channel = interaction.user.voice.channel
     voice_client = interaction.guild.voice_client
 
-    if voice_client:
-        if voice_client.channel != channel:
-            await voice_client.move_to(channel)
-    else:
-        voice_client = await channel.connect()
+    with trace_span("voice.connect"):
+        if voice_client:
+            if voice_client.channel != channel:
+                await voice_client.move_to(channel)
+        else:
+            voice_client = await channel.connect()
 
     try:
         loop = asyncio.get_event_loop()
@@ -349,95 +3311,225 @@ async def play(interaction: discord.Interaction, url: str):
         # Use extract_flat to get playlist items quickly without downloading
         # For Spotify, yt-dlp might not support it well directly, but let's try standard extraction first
         # If it's a playlist, 'entries' will be present
-        ytdl_opts = {
-            'extract_flat': 'in_playlist',
-            'quiet': True,
-            'default_search': 'auto',
-            'ignoreerrors': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ytdl_opts) as ydl:
-            data = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
+        # A suggestion picked from the autocomplete list is already known
+        data = search_cache.track(url)
+        if data is None:
+            with trace_span("extract.cache"):
+                data = await loop.run_in_executor(None, extract_cache.get_listing, url)
+        partial = False
+        if data is None:
+            # Only fetch the head of a playlist here; the rest is ingested in the background
+            await notify_if_busy(interaction, extraction.budget, PRIORITY_INTERACTIVE, "обработка ссылки")
+            with trace_span("extract.listing"):
+                data = await extraction.extract(interaction.guild_id, url, flat=True, items=f"1-{PLAYLIST_FIRST_BATCH}")
+            partial = 'entries' in data and data['count'] >= PLAYLIST_FIRST_BATCH
+            if not partial:
+                await loop.run_in_executor(None, extract_cache.put_listing, url, data)
 
         if 'entries' in data:
             # It's a playlist
-            entries = list(data['entries'])
-            added_count = 0
-            
-            if interaction.guild_id not in music_queues:
-                music_queues[interaction.guild_id] = []
-                
-            for entry in entries:
-                if entry:
-                    title = entry.get('title', 'Unknown Track')
-                    web_url = entry.get('url')
-                    # For some extractors, url might be missing or different, handle accordingly
-                    if not web_url:
-                        web_url = entry.get('webpage_url')
-                    
-                    if web_url:
-                        music_queues[interaction.guild_id].append({'web_url': web_url, 'title': title})
-                        added_count += 1
-            
-            await interaction.followup.send(f"📚 **Плейлист добавлен!** ({added_count} треков)", ephemeral=True)
+            added_count = enqueue_entries(interaction.guild_id, data['entries'])
+
+            if partial:
+                message = await interaction.followup.send(
+                    playlist_loading_text(added_count, data.get('total')), ephemeral=True, wait=True
+                )
+                task = asyncio.ensure_future(ingest_playlist(interaction, url, message, data, added_count))
+                playlist_imports.setdefault(interaction.guild_id, set()).add(task)
+            else:
+                await interaction.followup.send(f"📚 **Плейлист добавлен!** ({added_count} треков)", ephemeral=True)
             
         else:
             # Single track
             title = data.get('title', 'Unknown')
             web_url = data.get('webpage_url', url) # fallback to input url if needed
             
-            if interaction.guild_id not in music_queues:
-                music_queues[interaction.guild_id] = []
-                
-            music_queues[interaction.guild_id].append({'web_url': web_url, 'title': title})
+            get_queue(interaction.guild_id).append(Track(web_url, title))
             await interaction.followup.send(f"🎵 **Добавлено в очередь:** {title}", ephemeral=True)
 
         # If nothing is playing, start the queue
-        if not voice_client.is_playing():
-            await play_next(interaction)
-        
+        if not voice_client.is_playing() and interaction.guild_id not in waiting_for_stream:
+            if await notify_if_busy(interaction, stream_budget, PRIORITY_PLAYBACK, "воспроизведение"):
+                asyncio.ensure_future(play_next(interaction))
+            else:
+                await play_next(interaction)
+        else:
+            schedule_prefetch(interaction.guild_id)
+
+    except asyncio.CancelledError:
+        # /stop or /leave cancelled the extraction
+        await interaction.followup.send("⏹️ Загрузка отменена.", ephemeral=True)
+    except asyncio.TimeoutError:
+        await interaction.followup.send("⌛ Ссылка обрабатывается слишком долго, попробуйте позже.", ephemeral=True)
     except Exception as e:
+        ERRORS_TOTAL.inc("play")
         await interaction.followup.send(f"Ошибка при обработке ссылки: {str(e)}", ephemeral=True)
 
+@play.autocomplete("url")
+async def play_autocomplete(interaction: discord.Interaction, current: str):
+    query = normalize_query(current)
+    if len(query) < SEARCH_MIN_LENGTH or "://" in query or not is_allowed(interaction):
+        return []
+
+    results = search_cache.get(query)
+    if results is not None:
+        SEARCH_REQUESTS.inc("hit")
+        return search_choices(results)
+    preview = search_cache.closest(query) or []
+
+    # Debounce: wait for the user to pause; a newer keystroke takes over the search
+    user_id = interaction.user.id
+    latest_queries[user_id] = query
+    await asyncio.sleep(SEARCH_DEBOUNCE)
+    if latest_queries.get(user_id) != query:
+        SEARCH_REQUESTS.inc("debounced")
+        return search_choices(preview)
+    del latest_queries[user_id]
+
+    try:
+        results = await asyncio.wait_for(search_tracks(interaction.guild_id, query), SEARCH_WAIT)
+    except asyncio.TimeoutError:
+        SEARCH_REQUESTS.inc("slow")
+        return search_choices(preview)
+    except Exception:
+        return search_choices(preview)
+    return search_choices(results)
+
 @bot.tree.command(name="skip", description="Пропустить текущий трек")
 async def skip(interaction: discord.Interaction):
     if not await check_permissions(interaction): return
 
     if interaction.guild.voice_client and interaction.guild.voice_client.is_playing():
         interaction.guild.voice_client.stop() # This triggers 'after' callback which calls play_next
+        SKIPS_TOTAL.inc()
         await interaction.response.send_message("⏭️ Трек пропущен.", ephemeral=True)
     else:
         await interaction.response.send_message("Сейчас ничего не играет.", ephemeral=True)
 
+@bot.tree.command(name="previous", description="Вернуться к предыдущему треку")
+async def previous(interaction: discord.Interaction):
+    if not await check_permissions(interaction): return
+
+    q = get_queue(interaction.guild_id)
+    track = q.previous()
+    if not track:
+        await interaction.response.send_message("История пуста.", ephemeral=True)
+        return
+
+    voice_client = interaction.guild.voice_client
+    await interaction.response.send_message(f"⏮️ Возвращаюсь к: **{track.title}**", ephemeral=True)
+    if voice_client and voice_client.is_playing():
+        voice_client.stop() # 'after' callback plays the track we just put in front
+    elif voice_client:
+        await play_next(interaction)
+
+QUEUE_PAGE_SIZE = 10
+
+def build_queue_embed(q, page):
+    pages = max(1, (len(q) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE)
+    page = min(page, pages - 1)
+    embed = discord.Embed(title="📂 Музыкальная очередь", color=0x3498db)
+
+    desc = ""
+    if q.current:
+        desc += f"▶️ **Сейчас играет:** {q.current.title}\n\n"
+
+    start = page * QUEUE_PAGE_SIZE
+    for i, track in enumerate(q.page(page, QUEUE_PAGE_SIZE), start + 1):
+        desc += f"**{i}.** {track.title}\n"
+
+    embed.description = desc
+    embed.set_footer(text=f"Страница {page + 1}/{pages} • Всего треков: {len(q)}")
+    return embed
+
+class QueueView(discord.ui.View):
+    def __init__(self, guild_id, page=0):
+        super().__init__(timeout=120)
+        self.guild_id = guild_id
+        self.page = page
+
+    async def show(self, interaction, page):
+        q = get_queue(self.guild_id)
+        pages = max(1, (len(q) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE)
+        self.page = max(0, min(page, pages - 1))
+        await interaction.response.edit_message(embed=build_queue_embed(q, self.page), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
 @bot.tree.command(name="queue", description="Показать очередь воспроизведения")
-async def queue(interaction: discord.Interaction):
+@app_commands.describe(page="Номер страницы")
+async def queue(interaction: discord.Interaction, page: int = 1):
     if not await check_permissions(interaction): return
     
-    q = music_queues.get(interaction.guild_id, [])
+    q = get_queue(interaction.guild_id)
     
+    if not q and not q.current:
+        await interaction.response.send_message("📂 Очередь пуста.", ephemeral=True)
+        return
+
+    view = QueueView(interaction.guild_id, max(0, page - 1))
+    embed = build_queue_embed(q, view.page)
+    if len(q) > QUEUE_PAGE_SIZE:
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    else:
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="shuffle", description="Перемешать очередь")
+async def shuffle(interaction: discord.Interaction):
+    if not await check_permissions(interaction): return
+
+    q = get_queue(interaction.guild_id)
     if not q:
         await interaction.response.send_message("📂 Очередь пуста.", ephemeral=True)
         return
-        
-    embed = discord.Embed(title="📂 Музыкальная очередь", color=0x3498db)
-    
-    desc = ""
-    for i, song in enumerate(q[:10], 1): # Show max 10
-        desc += f"**{i}.** {song['title']}\n"
-        
-    if len(q) > 10:
-        desc += f"\n*...и еще {len(q) - 10} треков*"
-        
-    embed.description = desc
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    q.shuffle()
+    schedule_prefetch(interaction.guild_id)
+    await interaction.response.send_message(f"🔀 Очередь перемешана ({len(q)} треков).", ephemeral=True)
+
+@bot.tree.command(name="remove", description="Удалить трек из очереди")
+@app_commands.describe(position="Номер трека в очереди")
+async def remove(interaction: discord.Interaction, position: int):
+    if not await check_permissions(interaction): return
+
+    q = get_queue(interaction.guild_id)
+    if not 1 <= position <= len(q):
+        await interaction.response.send_message("Нет трека с таким номером.", ephemeral=True)
+        return
+
+    track = q.remove(position - 1)
+    await interaction.response.send_message(f"🗑️ Удален: **{track.title}**", ephemeral=True)
+
+@bot.tree.command(name="move", description="Переместить трек в очереди")
+@app_commands.describe(position="Текущий номер трека", new_position="Новый номер трека")
+async def move(interaction: discord.Interaction, position: int, new_position: int):
+    if not await check_permissions(interaction): return
+
+    q = get_queue(interaction.guild_id)
+    if not 1 <= position <= len(q) or not 1 <= new_position <= len(q):
+        await interaction.response.send_message("Нет трека с таким номером.", ephemeral=True)
+        return
+
+    track = q.move(position - 1, new_position - 1)
+    schedule_prefetch(interaction.guild_id)
+    await interaction.response.send_message(f"↕️ **{track.title}** теперь на позиции {new_position}.", ephemeral=True)
 
 @bot.tree.command(name="stop", description="Остановить воспроизведение и очистить очередь")
 async def stop(interaction: discord.Interaction):
     if not await check_permissions(interaction): return
 
     # Clear queue
-    if interaction.guild_id in music_queues:
-        music_queues[interaction.guild_id] = []
+    cancel_speech(interaction.guild_id)
+    cancel_playlist_import(interaction.guild_id)
+    extraction.cancel_guild(interaction.guild_id, keep=shared_resolves(interaction.guild_id))
+    cancel_prefetch(interaction.guild_id)
+    get_queue(interaction.guild_id).clear()
 
     if interaction.guild.voice_client and interaction.guild.voice_client.is_playing():
         interaction.guild.voice_client.stop()
@@ -451,8 +3543,11 @@ async def leave(interaction: discord.Interaction):
 
     if interaction.guild.voice_client:
         # Clear queue on leave
-        if interaction.guild_id in music_queues:
-            music_queues[interaction.guild_id] = []
+        cancel_speech(interaction.guild_id)
+        cancel_playlist_import(interaction.guild_id)
+        extraction.cancel_guild(interaction.guild_id, keep=shared_resolves(interaction.guild_id))
+        cancel_prefetch(interaction.guild_id)
+        get_queue(interaction.guild_id).clear()
             
         await interaction.guild.voice_client.disconnect()
         await interaction.response.send_message("Отключился. 👋")
@@ -467,13 +3562,17 @@ async def help(interaction: discord.Interaction):
     
     embed.add_field(name="🗣️ Озвучка", value=(
         "`/say <текст>` - Озвучить текст\n"
-        "`/setvoice` - Выбрать голос (20+ вариантов)"
+        "`/setvoice` - Выбрать голос (20+ вариантов, для Edge TTS)\n"
+        "`/setengine` - Выбрать движок (Edge / Google / локальный)"
     ), inline=False)
 
     embed.add_field(name="🎵 Музыка", value=(
         "`/play <url>` - Играть (или добавить в очередь)\n"
         "`/skip` - Пропустить трек\n"
-        "`/queue` - Показать очередь\n"
+        "`/previous` - Предыдущий трек\n"
+        "`/queue [страница]` - Показать очередь\n"
+        "`/shuffle`, `/remove`, `/move` - Управление очередью\n"
+        "`/loudness` - Выровнять громкость треков\n"
         "`/stop` - Остановить и очистить"
     ), inline=False)
     
@@ -491,7 +3590,7 @@ async def help(interaction: discord.Interaction):
 async def sync_commands(ctx):
     if str(ctx.author.id) == ADMIN_ID:
         try:
-            synced = await bot.tree.sync()
+            synced = await sync_command_tree(force=True)
             await ctx.send(f"✅ Синхронизировано {len(synced)} команд глобально.")
         except Exception as e:
             await ctx.send(f"❌ Ошибка: {e}")
@@ -509,8 +3608,8 @@ async def admin_add(interaction: discord.Interaction, user: discord.User):
         return
     
     if user.id not in allowed_users:
-        allowed_users.append(user.id)
-        save_allowed_users(allowed_users)
+        allowed_users.add(user.id)
+        state_store.mark_user(user.id, True)
         await interaction.response.send_message(f"✅ Пользователь {user.mention} добавлен в белый список.", ephemeral=True)
     else:
         await interaction.response.send_message(f"ℹ️ Пользователь {user.mention} уже в списке.", ephemeral=True)
@@ -523,8 +3622,8 @@ async def admin_remove(interaction: discord.Interaction, user: discord.User):
         return
     
     if user.id in allowed_users:
-        allowed_users.remove(user.id)
-        save_allowed_users(allowed_users)
+        allowed_users.discard(user.id)
+        state_store.mark_user(user.id, False)
         await interaction.response.send_message(f"✅ Пользователь {user.mention} удален из белого списка.", ephemeral=True)
     else:
         await interaction.response.send_message(f"ℹ️ Пользователя {user.mention} нет в списке.", ephemeral=True)
@@ -541,37 +3640,519 @@ async def admin_list(interaction: discord.Interaction):
     
     # Format list
     msg = "**Белый список:**\n"
-    for uid in allowed_users:
+    for uid in sorted(allowed_users):
         msg += f"<@{uid}>\n"
     
     await interaction.response.send_message(msg, ephemeral=True)
 
-# --- Keep-Alive Server for Render ---
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
+@admin_group.command(name="ttscache", description="Статистика кэша озвучки")
+async def admin_ttscache(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    stats = tts_cache.stats()
+    msg = (
+        "**Кэш озвучки:**\n"
+        f"Записей: {stats['entries']}\n"
+        f"Память: {stats['bytes'] / 1024 / 1024:.1f} / {stats['max_bytes'] / 1024 / 1024:.1f} МБ\n"
+        f"Попадания: {stats['hits']} (с диска: {stats['disk_hits']})\n"
+        f"Промахи: {stats['misses']}\n"
+        f"Вытеснения: {stats['evictions']}"
+    )
+    if TTS_CACHE_DIR:
+        msg += (
+            f"\nДиск: {stats['disk_entries']} файлов, "
+            f"{stats['disk_bytes'] / 1024 / 1024:.1f} / {stats['disk_max_bytes'] / 1024 / 1024:.1f} МБ, "
+            f"вытеснено: {stats['disk_evictions']}"
+        )
+    await interaction.response.send_message(msg, ephemeral=True)
+
+@admin_group.command(name="extcache", description="Кэш ссылок yt-dlp: статистика или очистка")
+@app_commands.describe(action="Что сделать")
+@app_commands.choices(action=[
+    app_commands.Choice(name="Статистика", value="stats"),
+    app_commands.Choice(name="Очистить", value="purge"),
+])
+async def admin_extcache(interaction: discord.Interaction, action: app_commands.Choice[str]):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    loop = asyncio.get_event_loop()
+    if action.value == "purge":
+        await loop.run_in_executor(None, extract_cache.purge)
+        resolved_streams.clear()
+        search_cache.clear()
+        await interaction.response.send_message("🗑️ Кэш ссылок очищен.", ephemeral=True)
+        return
+
+    stats = await loop.run_in_executor(None, extract_cache.stats)
+    search = search_cache.stats()
+    msg = (
+        "**Кэш ссылок:**\n"
+        f"Плейлисты/запросы: {stats['listings']}\n"
+        f"Треки: {stats['tracks']}\n"
+        f"Размер файла: {stats['bytes'] / 1024:.0f} КБ\n"
+        f"Попадания: {stats['hits']}\n"
+        f"Промахи: {stats['misses']}\n"
+        f"Поиск /play: {search['queries']} запросов, {search['tracks']} треков, сейчас ищется {search['in_flight']}"
+    )
+    await interaction.response.send_message(msg, ephemeral=True)
+
+@admin_group.command(name="trackcache", description="Статистика кэша популярных треков")
+async def admin_trackcache(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    if not track_cache:
+        await interaction.response.send_message("ℹ️ Кэш треков выключен (задайте `TRACK_CACHE_DIR`).", ephemeral=True)
+        return
+
+    stats = await asyncio.get_event_loop().run_in_executor(None, track_cache.stats)
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / lookups * 100 if lookups else 0
+    msg = (
+        "**Кэш треков:**\n"
+        f"Треков: {stats['entries']}\n"
+        f"Диск: {stats['bytes'] / 1024 / 1024:.0f} / {stats['max_bytes'] / 1024 / 1024:.0f} МБ\n"
+        f"Попадания: {stats['hits']} из {lookups} ({hit_rate:.0f}%)\n"
+        f"Закэшировано: {stats['fills']} (ошибок: {stats['fill_failures']}, сейчас: {stats['filling']})\n"
+        f"Вытеснения: {stats['evictions']}"
+    )
+    await interaction.response.send_message(msg, ephemeral=True)
+
+@admin_group.command(name="decoders", description="Статистика пула декодеров ffmpeg")
+async def admin_decoders(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    stats = decoder_pool.stats()
+    msg = (
+        "**Декодеры ffmpeg:**\n"
+        f"Готовы: {stats['idle']}, заняты: {stats['active']} / {stats['max_active']}, в очереди: {stats['queued']}\n"
+        f"Запущено процессов: {stats['spawned']}\n"
+        f"Из пула: {stats['warm_hits']}, холодный старт: {stats['cold_spawns']}\n"
+        f"Ожиданий: {stats['waits']} (сред. {stats['wait_avg'] * 1000:.0f} мс, макс. {stats['wait_max'] * 1000:.0f} мс)"
+    )
+    await interaction.response.send_message(msg, ephemeral=True)
+
+@admin_group.command(name="playback", description="Статистика воспроизведения по серверам")
+async def admin_playback(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    if not playback_path_stats:
+        await interaction.response.send_message("Пока ничего не воспроизводилось.", ephemeral=True)
+        return
 
-class KeepAliveHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is running")
+    msg = "**Воспроизведение:**\n"
+    for guild_id, stats in playback_path_stats.items():
+        guild = bot.get_guild(guild_id)
+        name = guild.name if guild else guild_id
+        paths = ", ".join(f"{path}: {stats[path]}" for path in PLAYBACK_PATHS)
+        msg += f"**{name}** — сейчас `{stats['last']}` ({paths})"
+        gaps = gap_stats.get(guild_id)
+        if gaps and gaps['count']:
+            msg += f", пауза между треками {gaps['total'] / gaps['count'] * 1000:.0f} мс"
+        msg += "\n"
 
-def run_server():
+    await interaction.response.send_message(msg[:2000], ephemeral=True)
+
+@admin_group.command(name="load", description="Загрузка: потоки, извлечение ссылок, очереди ожидания")
+async def admin_load(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    msg = "**Загрузка:**\n"
+    for label, budget in (("Музыкальные потоки", stream_budget), ("Извлечение ссылок", extraction.budget)):
+        stats = budget.stats()
+        msg += (
+            f"{label}: {stats['in_use']} / {stats['capacity']}, ждут: {stats['waiting']} "
+            f"(всего выдано {stats['granted']}, ждали {stats['queued']})\n"
+        )
+    connections = f"{len(bot.voice_clients)} / {MAX_VOICE_CONNECTIONS}" if MAX_VOICE_CONNECTIONS else str(len(bot.voice_clients))
+    msg += f"Голосовые подключения: {connections}"
+    await interaction.response.send_message(msg, ephemeral=True)
+
+@admin_group.command(name="loop", description="Задержки event loop и блокирующие вызовы")
+async def admin_loop(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    stats = loop_monitor.stats()
+    msg = (
+        "**Event loop:**\n"
+        f"Задержка: p50 {stats['p50'] * 1000:.1f} мс, p99 {stats['p99'] * 1000:.1f} мс, "
+        f"макс. {stats['max'] * 1000:.0f} мс (за {stats['samples']} замеров)\n"
+        f"Блокировок дольше {LOOP_SLOW_CALLBACK * 1000:.0f} мс: {len(stats['slow_callbacks'])}\n"
+    )
+    for slow in stats['slow_callbacks'][-5:]:
+        when = time.strftime('%H:%M:%S', time.localtime(slow['at']))
+        msg += f"`{when}` {slow['stalled'] * 1000:.0f}+ мс в `{slow['where']}`\n"
+    await interaction.response.send_message(msg[:2000], ephemeral=True)
+
+@admin_group.command(name="profile", description="Профилировать бота и прислать самые горячие места")
+@app_commands.describe(mode="Профилировщик", seconds="Сколько секунд профилировать")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="cProfile (event loop)", value="cprofile"),
+    app_commands.Choice(name="Сэмплирование (все потоки)", value="sampling"),
+])
+async def admin_profile(interaction: discord.Interaction, mode: app_commands.Choice[str], seconds: int = 30):
+    global active_profile
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    if active_profile:
+        await interaction.response.send_message("ℹ️ Профилирование уже идёт. Остановить: `/admin profilestop`.", ephemeral=True)
+        return
+
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    session = CProfileSession() if mode.value == "cprofile" else SamplingProfiler()
+    done = asyncio.Event()
+    try:
+        session.start()
+    except ValueError as e:
+        # Another profiler (e.g. a debugger) is already attached
+        await interaction.response.send_message(f"❌ Не удалось запустить: {e}", ephemeral=True)
+        return
+    active_profile = (mode.value, session, done)
+    await interaction.response.send_message(f"⏱️ Профилирую {seconds} с ({mode.name})...", ephemeral=True)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        session.stop()
+        active_profile = None
+
+    report = await asyncio.get_event_loop().run_in_executor(None, session.report)
+    name = f"profile-{mode.value}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    await interaction.followup.send(
+        "📊 Результаты профилирования:",
+        file=discord.File(io.BytesIO(report.encode()), filename=name),
+        ephemeral=True
+    )
+
+@admin_group.command(name="profilestop", description="Досрочно остановить профилирование")
+async def admin_profilestop(interaction: discord.Interaction):
+    if str(interaction.user.id) != ADMIN_ID:
+        await interaction.response.send_message("⛔ Вы не Админ!", ephemeral=True)
+        return
+
+    if not active_profile:
+        await interaction.response.send_message("ℹ️ Профилирование не запущено.", ephemeral=True)
+        return
+
+    active_profile[2].set()
+    await interaction.response.send_message("⏹️ Останавливаю, отчёт придёт отдельным сообщением.", ephemeral=True)
+
+# --- HTTP Server: Keep-Alive, Health and Metrics ---
+# Runs on the bot's event loop (aiohttp comes with discord.py). Render only
+# needs something listening on $PORT; the rest is for monitoring.
+metrics.register(Gauge(
+    "voicebot_queue_depth", "Tracks waiting in each guild's queue", ("guild",),
+    collect=lambda: {(guild_id,): len(q) for guild_id, q in music_queues.items()}
+))
+metrics.register(Gauge(
+    "voicebot_voice_client_active", "1 if the bot is playing in the guild, 0 if connected but idle", ("guild",),
+    collect=lambda: {(vc.guild.id,): int(vc.is_playing()) for vc in bot.voice_clients}
+))
+metrics.register(Gauge(
+    "voicebot_gateway_latency_seconds", "Discord gateway heartbeat latency",
+    collect=lambda: {(): bot.latency} if bot.is_ready() and math.isfinite(bot.latency) else {}
+))
+
+async def handle_root(request):
+    return web.Response(text="Bot is running")
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def handle_healthz(request):
+    # Liveness: the loop answered us, and the client hasn't been shut down
+    if bot.is_closed():
+        return web.json_response({'status': 'closed'}, status=503)
+    return web.json_response({'status': 'ok'})
+
+async def handle_readyz(request):
+    # Readiness: logged in to the gateway with a live heartbeat
+    ready = bot.is_ready() and not bot.is_closed() and math.isfinite(bot.latency)
+    voice = [
+        {'guild': vc.guild.id, 'connected': vc.is_connected(), 'playing': vc.is_playing()}
+        for vc in bot.voice_clients
+    ]
+    body = {
+        'status': 'ready' if ready else 'starting',
+        'latency': bot.latency if ready else None,
+        'guilds': len(bot.guilds),
+        'voice_clients': voice,
+    }
+    return web.json_response(body, status=200 if ready else 503)
+
+async def start_http_server():
+    app = web.Application()
+    app.router.add_get('/', handle_root)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
     port = int(os.getenv("PORT", 8080))
-    server = HTTPServer(('0.0.0.0', port), KeepAliveHandler)
-    print(f"Starting keep-alive server on port {port}")
-    server.serve_forever()
+    # Cluster workers listen on localhost only; the supervisor serves the public port
+    await web.TCPSite(runner, os.getenv("HTTP_HOST", "0.0.0.0"), port).start()
+    print(f"Starting HTTP server on port {port}")
+    return runner
+
+# --- Cluster Mode ---
+# With CLUSTER_WORKERS > 1 this process becomes a supervisor: it splits the
+# shards into contiguous ranges, runs one worker process (this same script,
+# as an AutoShardedBot) per range, restarts workers that die, and serves the
+# public HTTP port with health and metrics aggregated from the workers, which
+# listen on localhost ports after it.
+CLUSTER_RESTART_BACKOFF_MAX = 60
+# A worker that stayed up this long has its restart backoff reset
+CLUSTER_STABLE_SECONDS = 300
+
+CLUSTER_WORKER_RESTARTS = Counter(
+    "voicebot_cluster_worker_restarts_total", "Worker processes restarted by the supervisor", ("worker",))
+CLUSTER_WORKERS_UP = Gauge(
+    "voicebot_cluster_workers_up", "1 if the worker process is running", ("worker",))
+
+async def fetch_shard_count(token):
+    # Discord's recommended shard count for this bot
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            "https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}
+        ) as resp:
+            resp.raise_for_status()
+            return (await resp.json())['shards']
+
+def shard_ranges(shard_count, workers):
+    workers = min(workers, shard_count)
+    size, extra = divmod(shard_count, workers)
+    ranges, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def merge_metrics(texts):
+    # Combine Prometheus text from several workers into one exposition, keeping
+    # each metric family together and tagging every sample with its worker
+    families = {}
+    for worker, text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                family = families.setdefault(line.split(" ", 3)[2], {'help': line, 'type': None, 'samples': []})
+            elif line.startswith("# TYPE "):
+                family = families.setdefault(line.split(" ", 3)[2], {'help': None, 'type': None, 'samples': []})
+                family['type'] = line
+            elif line and family is not None:
+                name, _, rest = line.partition(" ")
+                if "{" in name:
+                    name = name.replace("{", f'{{worker="{worker}",', 1)
+                else:
+                    name = f'{name}{{worker="{worker}"}}'
+                family['samples'].append(f"{name} {rest}")
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family['help'], family['type']) if line)
+        lines.extend(family['samples'])
+    return "\n".join(lines) + "\n"
+
+class ClusterSupervisor:
+    def __init__(self, token, workers, shard_count, base_port):
+        self.token = token
+        self.ranges = shard_ranges(shard_count, workers)
+        self.shard_count = shard_count
+        self.base_port = base_port
+        self.processes = {}   # worker -> Popen
+        self.started_at = {}  # worker -> time.monotonic()
+        self.failures = {}    # worker -> consecutive quick crashes
+        self.stopping = False
+        self.registry = MetricsRegistry()
+        self.registry.register(CLUSTER_WORKER_RESTARTS)
+        self.registry.register(CLUSTER_WORKERS_UP)
+        CLUSTER_WORKERS_UP.collect = lambda: {
+            (worker,): int(process.poll() is None) for worker, process in self.processes.items()
+        }
+
+    def worker_port(self, worker):
+        return self.base_port + 1 + worker
+
+    def spawn(self, worker):
+        shards = self.ranges[worker]
+        env = dict(os.environ)
+        env.update({
+            'CLUSTER_ID': str(worker),
+            'SHARD_IDS': ",".join(map(str, shards)),
+            'SHARD_COUNT': str(self.shard_count),
+            'PORT': str(self.worker_port(worker)),
+            'HTTP_HOST': '127.0.0.1',
+        })
+        # PyInstaller builds are the script themselves
+        command = [sys.executable] if getattr(sys, 'frozen', False) else [sys.executable, os.path.abspath(__file__)]
+        self.processes[worker] = subprocess.Popen(command, env=env)
+        self.started_at[worker] = time.monotonic()
+        print(f"Cluster worker {worker} started (pid {self.processes[worker].pid}, shards {shards[0]}-{shards[-1]})")
+
+    async def supervise(self):
+        for worker in range(len(self.ranges)):
+            self.spawn(worker)
+        restart_at = {}
+        while not self.stopping:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for worker, process in self.processes.items():
+                if process.poll() is None or self.stopping:
+                    continue
+                if worker not in restart_at:
+                    if now - self.started_at[worker] > CLUSTER_STABLE_SECONDS:
+                        self.failures[worker] = 0
+                    self.failures[worker] = self.failures.get(worker, 0) + 1
+                    delay = min(CLUSTER_RESTART_BACKOFF_MAX, 2 ** (self.failures[worker] - 1))
+                    restart_at[worker] = now + delay
+                    print(f"⚠️ Cluster worker {worker} exited with code {process.returncode}, restarting in {delay} s")
+                elif now >= restart_at[worker]:
+                    del restart_at[worker]
+                    CLUSTER_WORKER_RESTARTS.inc(worker)
+                    self.spawn(worker)
+
+    async def fetch_all(self, path):
+        # (worker, status, body) for every worker; status is None if unreachable
+        async def fetch(session, worker):
+            try:
+                async with session.get(f"http://127.0.0.1:{self.worker_port(worker)}{path}") as resp:
+                    return worker, resp.status, await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return worker, None, None
+        timeout = aiohttp.ClientTimeout(total=5)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return await asyncio.gather(*(fetch(session, worker) for worker in self.processes))
 
-def start_keep_alive():
-    t = threading.Thread(target=run_server)
-    t.daemon = True
-    t.start()
+    async def handle_metrics(self, request):
+        results = await self.fetch_all("/metrics")
+        texts = [(worker, body) for worker, status, body in results if status == 200]
+        # The supervisor's own metrics already carry a worker label
+        text = merge_metrics(texts) + self.registry.render()
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    async def handle_healthz(self, request):
+        dead = [worker for worker, process in self.processes.items() if process.poll() is not None]
+        if dead:
+            return web.json_response({'status': 'degraded', 'dead_workers': dead}, status=503)
+        return web.json_response({'status': 'ok', 'workers': len(self.processes)})
+
+    async def handle_readyz(self, request):
+        results = await self.fetch_all("/readyz")
+        workers = {
+            worker: json.loads(body) if body else {'status': 'unreachable'}
+            for worker, status, body in results
+        }
+        ready = all(status == 200 for _, status, _ in results)
+        return web.json_response(
+            {'status': 'ready' if ready else 'starting', 'workers': workers}, status=200 if ready else 503
+        )
+
+    def shutdown(self):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+async def run_supervisor(token):
+    shard_count = int(os.getenv("SHARD_COUNT", 0)) or await fetch_shard_count(token)
+    supervisor = ClusterSupervisor(token, CLUSTER_WORKERS, shard_count, int(os.getenv("PORT", 8080)))
+    print(f"Cluster mode: {shard_count} shards across {len(supervisor.ranges)} workers")
+
+    app = web.Application()
+    app.router.add_get('/', handle_root)
+    app.router.add_get('/metrics', supervisor.handle_metrics)
+    app.router.add_get('/healthz', supervisor.handle_healthz)
+    app.router.add_get('/readyz', supervisor.handle_readyz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', supervisor.base_port).start()
+    print(f"Starting HTTP server on port {supervisor.base_port}")
+    on_signal(signal.SIGTERM, lambda: setattr(supervisor, 'stopping', True))
+    try:
+        await supervisor.supervise()
+    finally:
+        supervisor.shutdown()
+        await runner.cleanup()
+
+def warm_up_audio():
+    started = time.perf_counter()
+    if ensure_ffmpeg():
+        decoder_pool.warm_up()
+        print(f"ffmpeg ready in {(time.perf_counter() - started) * 1000:.0f} ms")
+    else:
+        print("❌ ffmpeg not found: voice playback will not work")
+
+def on_signal(signum, callback):
+    # Not available on Windows; Ctrl+C still works there
+    try:
+        asyncio.get_running_loop().add_signal_handler(signum, callback)
+    except NotImplementedError:
+        pass
+
+async def run_bot(token):
+    # Bind the port before logging in so Render's port scan succeeds right away
+    runner = await start_http_server()
+    mark_startup("http server")
+    # ffmpeg lookup (maybe a download) and decoder warm-up don't hold up the login
+    asyncio.get_running_loop().run_in_executor(None, warm_up_audio)
+    # Close cleanly on SIGTERM (Render deploys, the cluster supervisor) so state gets flushed
+    on_signal(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    loop_monitor.start()
+    state_store.start()
+    try:
+        async with bot:
+            await bot.start(token)
+    finally:
+        loop_monitor.stop()
+        await runner.cleanup()
+
+mark_startup("module init")
 
 if __name__ == "__main__":
+    # Needed for the extraction process pool in PyInstaller builds
+    multiprocessing.freeze_support()
     token = os.getenv("DISCORD_TOKEN")
     if not token:
         print("Error: DISCORD_TOKEN not found.")
     else:
-        # Start the dummy web server for Render
-        start_keep_alive()
-        bot.run(token)
+        # bot.run() would do this for us; bot.start() doesn't
+        discord.utils.setup_logging()
+        if CLUSTER_WORKERS > 1 and CLUSTER_ID is None:
+            try:
+                asyncio.run(run_supervisor(token))
+            except KeyboardInterrupt:
+                pass
+        else:
+            try:
+                asyncio.run(run_bot(token))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                extraction.shutdown()
+                decoder_pool.shutdown()
+                state_store.close()
+                loudness_index.shutdown()
+                if track_cache:
+                    track_cache.shutdown()